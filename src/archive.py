@@ -0,0 +1,102 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Compact, compressed archive of finished SparkApplications."""
+
+import hashlib
+import json
+import sqlite3
+import zlib
+from pathlib import Path
+from typing import List, Optional, Union
+
+from spark_application import TERMINAL_STATES, application_state, parse_time
+
+
+def application_record(app) -> Optional[dict]:
+    """Build the archive record of a finished SparkApplication.
+
+    Returns:
+        The record, or None if the application has not finished yet.
+    """
+    state = application_state(app)
+    status = app.status or {}
+    termination_time = parse_time(status.get("terminationTime"))
+    if state not in TERMINAL_STATES or termination_time is None:
+        return None
+
+    executor_states = status.get("executorState") or {}
+    return {
+        "name": app.metadata.name,
+        "namespace": app.metadata.namespace,
+        "uid": app.metadata.uid,
+        "spec_hash": hashlib.sha256(json.dumps(app.spec, sort_keys=True).encode()).hexdigest(),
+        "state": state,
+        "error": status.get("applicationState", {}).get("errorMessage", ""),
+        "submission_time": parse_time(status.get("lastSubmissionAttemptTime")),
+        "termination_time": termination_time,
+        "submission_attempts": status.get("submissionAttempts", 0),
+        "execution_attempts": status.get("executionAttempts", 0),
+        "executors": len(executor_states),
+        "failed_executors": sum(1 for s in executor_states.values() if s == "FAILED"),
+    }
+
+
+class ApplicationArchive:
+    """SQLite store of zlib-compressed application records, indexed by name and time."""
+
+    def __init__(self, path: Union[str, Path]):
+        self._connection = sqlite3.connect(str(path))
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS applications ("
+                "uid TEXT PRIMARY KEY, name TEXT, termination_time REAL, record BLOB)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS applications_name ON applications (name)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS applications_time ON applications (termination_time)"
+            )
+
+    def add(self, record: dict) -> None:
+        """Store a record, replacing any previous record of the same application."""
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO applications VALUES (?, ?, ?, ?)",
+                (
+                    record["uid"],
+                    record["name"],
+                    record["termination_time"],
+                    zlib.compress(json.dumps(record, sort_keys=True).encode()),
+                ),
+            )
+
+    def query(
+        self,
+        name: Optional[str] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        limit: int = 50,
+    ) -> List[dict]:
+        """Return the most recently terminated records matching the filters."""
+        clauses, params = [], []
+        if name:
+            clauses.append("name = ?")
+            params.append(name)
+        if since is not None:
+            clauses.append("termination_time >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("termination_time <= ?")
+            params.append(until)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = self._connection.execute(
+            f"SELECT record FROM applications {where} ORDER BY termination_time DESC LIMIT ?",
+            (*params, limit),
+        )
+        return [json.loads(zlib.decompress(record)) for (record,) in rows]
+
+    def close(self) -> None:
+        """Close the underlying database."""
+        self._connection.close()
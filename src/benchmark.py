@@ -0,0 +1,118 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Submission-latency benchmark of the Spark Operator."""
+
+import copy
+import math
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List
+
+from spark_application import (
+    TERMINAL_STATES,
+    SparkApplication,
+    application_state,
+    parse_time,
+)
+
+BENCHMARK_LABEL = "spark-k8s.charm/benchmark"
+
+
+def percentiles(values: Iterable[float], ranks: Iterable[int] = (50, 95, 99)) -> Dict[str, float]:
+    """Nearest-rank percentiles of `values`, keyed p50, p95, ..., empty if there are none."""
+    ordered = sorted(values)
+    if not ordered:
+        return {}
+    return {
+        f"p{rank}": round(ordered[max(math.ceil(rank / 100 * len(ordered)) - 1, 0)], 3)
+        for rank in ranks
+    }
+
+
+class SubmissionBenchmark:
+    """Submits copies of a SparkApplication and measures how the operator handles them.
+
+    Timings start from the moment the charm created each object. SUBMITTED and
+    end-to-end times come from `lastSubmissionAttemptTime` and `terminationTime`,
+    which have a resolution of one second. RUNNING is when the state was first
+    observed, so its resolution is the poll interval.
+    """
+
+    def __init__(self, client, manifest: dict, namespace: str):
+        self._client = client
+        self._manifest = manifest
+        self._namespace = namespace
+        self.run_id = uuid.uuid4().hex[:8]
+
+    def _application(self, index: int):
+        manifest = copy.deepcopy(self._manifest)
+        metadata = manifest.setdefault("metadata", {})
+        metadata["name"] = f"{metadata.get('name', 'spark')}-bench-{self.run_id}-{index}"
+        metadata.setdefault("labels", {})[BENCHMARK_LABEL] = self.run_id
+        return SparkApplication.from_dict(manifest)
+
+    def _submit(self, index: int) -> tuple:
+        app = self._application(index)
+        submitted = time.time()
+        self._client.create(app, namespace=self._namespace)
+        return app.metadata.name, submitted
+
+    def run(
+        self, count: int, concurrency: int, timeout: float, poll_interval: float = 1.0
+    ) -> dict:
+        """Submit `count` applications, `concurrency` at a time, and wait for them to finish.
+
+        Returns:
+            Latency percentiles in seconds and the number of applications per outcome.
+        """
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            submit_times = dict(pool.map(self._submit, range(count)))
+
+        running_times: Dict[str, float] = {}
+        finished: Dict[str, object] = {}
+        deadline = time.time() + timeout
+        while len(finished) < count and time.time() < deadline:
+            time.sleep(poll_interval)
+            for app in self._client.list(
+                SparkApplication,
+                namespace=self._namespace,
+                labels={BENCHMARK_LABEL: self.run_id},
+            ):
+                name = app.metadata.name
+                state = application_state(app)
+                if state == "RUNNING" and name not in running_times:
+                    running_times[name] = time.time()
+                if state in TERMINAL_STATES:
+                    finished[name] = app
+
+        submitted: List[float] = []
+        ended: List[float] = []
+        for name, app in finished.items():
+            status = app.status or {}
+            submission = parse_time(status.get("lastSubmissionAttemptTime"))
+            termination = parse_time(status.get("terminationTime"))
+            if submission is not None:
+                submitted.append(max(submission - submit_times[name], 0.0))
+            if termination is not None:
+                ended.append(termination - submit_times[name])
+
+        states = [application_state(app) for app in finished.values()]
+        return {
+            "submitted": percentiles(submitted),
+            "running": percentiles(
+                running - submit_times[name] for name, running in running_times.items()
+            ),
+            "end-to-end": percentiles(ended),
+            "completed": states.count("COMPLETED"),
+            "failed": states.count("FAILED"),
+            "timed-out": count - len(finished),
+        }
+
+    def cleanup(self) -> None:
+        """Delete the applications created by this run."""
+        for app in self._client.list(
+            SparkApplication, namespace=self._namespace, labels={BENCHMARK_LABEL: self.run_id}
+        ):
+            self._client.delete(SparkApplication, app.metadata.name, namespace=self._namespace)
@@ -0,0 +1,142 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Self-signed CA and server certificate of the admission webhook."""
+
+import tempfile
+from pathlib import Path
+from subprocess import check_call
+
+# openssl commands generating a private key into the {key} file
+KEY_ALGORITHMS = {
+    "ecdsa-p256": [
+        "openssl",
+        "ecparam",
+        "-name",
+        "prime256v1",
+        "-genkey",
+        "-noout",
+        "-out",
+        "{key}",
+    ],
+    "rsa-2048": ["openssl", "genrsa", "-out", "{key}", "2048"],
+}
+
+_SSL_CONF = """[ req ]
+default_bits = 2048
+prompt = no
+default_md = sha256
+req_extensions = req_ext
+distinguished_name = dn
+[ dn ]
+C = GB
+ST = Canonical
+L = Canonical
+O = Canonical
+OU = Canonical
+CN = 127.0.0.1
+[ req_ext ]
+subjectAltName = @alt_names
+[ alt_names ]
+DNS.1 = {app}
+DNS.2 = {app}.{model}
+DNS.3 = {app}.{model}.svc
+DNS.4 = {app}.{model}.svc.cluster
+DNS.5 = {app}.{model}.svc.cluster.local
+IP.1 = 127.0.0.1
+[ v3_ext ]
+authorityKeyIdentifier=keyid,issuer:always
+basicConstraints=CA:FALSE
+keyUsage={key_usage}
+extendedKeyUsage=serverAuth,clientAuth
+subjectAltName=@alt_names"""
+
+
+def _gen_key(algorithm: str, path: Path) -> None:
+    check_call([arg.format(key=path) for arg in KEY_ALGORITHMS[algorithm]])
+
+
+def gen_certs(app: str, model: str, algorithm: str = "ecdsa-p256") -> dict:
+    """Generate a CA and a server key and certificate for the Service of the webhook.
+
+    Args:
+        app: name of the application, and of its Service
+        model: name of the model, and namespace of the Service
+        algorithm: one of KEY_ALGORITHMS, used for both the CA and the server keys
+
+    Returns:
+        The PEM encoded server certificate, server key and CA certificate.
+    """
+    # Only RSA keys can encipher keys, ECDSA keys only sign the key exchange
+    key_usage = "digitalSignature"
+    if algorithm.startswith("rsa"):
+        key_usage = "keyEncipherment,dataEncipherment,digitalSignature"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        run = Path(tmp)
+        (run / "ssl.conf").write_text(_SSL_CONF.format(app=app, model=model, key_usage=key_usage))
+        _gen_key(algorithm, run / "ca.key")
+        _gen_key(algorithm, run / "server.key")
+        check_call(
+            [
+                "openssl",
+                "req",
+                "-x509",
+                "-new",
+                "-sha256",
+                "-nodes",
+                "-days",
+                "3650",
+                "-key",
+                f"{run}/ca.key",
+                "-subj",
+                "/CN=127.0.0.1",
+                "-out",
+                f"{run}/ca.crt",
+            ]
+        )
+        check_call(
+            [
+                "openssl",
+                "req",
+                "-new",
+                "-sha256",
+                "-key",
+                f"{run}/server.key",
+                "-out",
+                f"{run}/server.csr",
+                "-subj",
+                f"/CN={app}.{model}.svc",
+                "-config",
+                f"{run}/ssl.conf",
+            ]
+        )
+        check_call(
+            [
+                "openssl",
+                "x509",
+                "-req",
+                "-sha256",
+                "-in",
+                f"{run}/server.csr",
+                "-CA",
+                f"{run}/ca.crt",
+                "-CAkey",
+                f"{run}/ca.key",
+                "-CAcreateserial",
+                "-out",
+                f"{run}/cert.pem",
+                "-days",
+                "365",
+                "-extensions",
+                "v3_ext",
+                "-extfile",
+                f"{run}/ssl.conf",
+            ]
+        )
+
+        return {
+            "cert": (run / "cert.pem").read_text(),
+            "key": (run / "server.key").read_text(),
+            "ca": (run / "ca.crt").read_text(),
+        }
@@ -2,27 +2,55 @@
 # Copyright 2022 Canonical Ltd.
 # See LICENSE file for licensing details.
 
+import base64
 import glob
+import hashlib
+import json
 import logging
+import os
+import re
+import socket
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor, wait
+from itertools import islice
 from pathlib import Path
-from subprocess import check_call
+from typing import Optional
+from urllib.request import urlopen
 
+import yaml
 from charmed_kubeflow_chisme.exceptions import ErrorWithStatus
 from charmed_kubeflow_chisme.kubernetes import KubernetesResourceHandler as KRH
-from charmed_kubeflow_chisme.lightkube.batch import delete_many
+from charmed_kubeflow_chisme.lightkube.batch import apply_many
 from charms.observability_libs.v1.kubernetes_service_patch import KubernetesServicePatch
-from charms.prometheus_k8s.v0.prometheus_scrape import MetricsEndpointProvider
-from lightkube import Client
-from lightkube.core.exceptions import ApiError
+from lightkube import Client, operators
+from lightkube.core.exceptions import ApiError, ConfigError
 from lightkube.models.core_v1 import ServicePort
+from lightkube.models.meta_v1 import ObjectMeta
 from lightkube.resources.admissionregistration_v1 import MutatingWebhookConfiguration
-from ops.charm import CharmBase
+from lightkube.resources.apps_v1 import DaemonSet, Deployment
+from lightkube.resources.core_v1 import ConfigMap, Pod, ResourceQuota, Service
+from lightkube.resources.networking_v1 import Ingress
+from lightkube.resources.scheduling_v1 import PriorityClass
+from ops.charm import CharmBase, InstallEvent, UpgradeCharmEvent
 from ops.framework import StoredState
 from ops.main import main
 from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus, WaitingStatus
 from ops.pebble import ChangeError, Layer, PathError, ProtocolError
 
+from archive import ApplicationArchive, application_record
+from benchmark import SubmissionBenchmark
+from certs import KEY_ALGORITHMS, gen_certs
+from charm_metrics import CharmMetrics
+from metrics_endpoint import MetricsEndpoint
+from pushgateway import evict_stale_groups, push_group
+from spark_application import (
+    ScheduledSparkApplication,
+    SparkApplication,
+    parse_time,
+    with_profile,
+)
+
 log = logging.getLogger()
 
 
@@ -31,43 +59,98 @@ class SparkCharm(CharmBase):
 
     _stored = StoredState()
 
+    _shuffle_dir = "/var/lib/spark-shuffle"
+    _scratch_dir = "/var/lib/spark-scratch"
+    _placement_policies = ("", "bin-pack", "spread")
+    # Upper bound on the applications pruned per hook, to keep update-status short
+    _prune_batch_size = 100
+    # Parallelism, page size and time budget of the teardown in the remove hook
+    _teardown_workers = 10
+    _teardown_page_size = 500
+    _teardown_timeout = 300
+    # Pods the webhook is called for, by the label Spark sets on driver and executor pods
+    _webhook_object_selector = {
+        "matchExpressions": [
+            {"key": "spark-role", "operator": "In", "values": ["driver", "executor"]}
+        ]
+    }
+    # Seconds a hook waits for the operator to become ready after it was (re)started
+    _ready_timeout = 30
+    _shuffle_service_port = 7337
+
     def __init__(self, *args):
         super().__init__(*args)
 
-        jobs = [
-            {
-                "static_configs": [
-                    {
-                        "targets": ["*:8080"],
-                    }
-                ],
-            }
-        ]
+        self.charm_metrics = CharmMetrics(
+            hook=Path(os.environ.get("JUJU_DISPATCH_PATH", "unknown")).name
+        )
+        self._stored.set_default(
+            charm_metrics="",
+            applied_manifests={},
+            service_ports="",
+            operator_started_at=0.0,
+            cert="",
+            key="",
+            ca="",
+            key_algorithm="",
+        )
 
-        self.metrics_endpoint = MetricsEndpointProvider(self, jobs=jobs)
+        # Scraped by one of the jobs of the metrics endpoint
+        self._pushgateway_name = f"{self.model.app.name}-pushgateway"
+        self.metrics_endpoint = MetricsEndpoint(
+            self, jobs=self._scrape_jobs, refresh_event=self.on.spark_pebble_ready
+        )
 
-        self._stored.set_default(**self.gen_certs())
+        self._certs_rotated = False
+        self._update_certs()
 
-        port = ServicePort(int(self.model.config["webhook-port"]), name=f"{self.app.name}")
-        self.service_patcher = KubernetesServicePatch(self, [port])
+        ports = [ServicePort(int(self.model.config["webhook-port"]), name=f"{self.app.name}")]
+        if self._history_server_enabled:
+            ports.append(
+                ServicePort(
+                    int(self.model.config["history-server-port"]),
+                    name=f"{self.app.name}-history-server",
+                )
+            )
+        self.service_patcher = KubernetesServicePatch(self, ports)
 
         self.lightkube_client = Client(namespace=self.model.name, field_manager="lightkube")
+        self.charm_metrics.instrument(self.lightkube_client)
 
         self.resource_handler = KRH(
             template_files=self._template_files,
             context=self._context,
             field_manager=self.model.app.name,
+            lightkube_client=self.lightkube_client,
         )
 
         self._mutating_webhook_name = f"{self.model.app.name}-webhook-config"
+        self._shuffle_service_name = f"{self.model.app.name}-shuffle-service"
+        self._prepull_name = f"{self.model.app.name}-image-prepull"
         self._container_name = "spark"
         self.container = self.unit.get_container(self._container_name)
+        self._spark_defaults_file = "/opt/spark/conf/spark-defaults.conf"
+        self._pod_templates_dir = "/etc/spark-k8s/pod-templates"
+        self._history_storage_dir = "/var/lib/spark-history"
 
-        self.framework.observe(self.on.install, self._on_install)
-        self.framework.observe(self.on.spark_pebble_ready, self._on_spark_pebble_ready)
-        self.framework.observe(self.on.config_changed, self._on_config_changed)
-        self.framework.observe(self.on.config_changed, self.service_patcher._patch)
+        for event in (
+            self.on.install,
+            self.on.upgrade_charm,
+            self.on.config_changed,
+            self.on.leader_elected,
+            self.on.spark_pebble_ready,
+            self.on.spark_relation_joined,
+            self.on.replicas_relation_changed,
+            self.on.spark_history_storage_attached,
+        ):
+            self.framework.observe(event, self._reconcile)
+        self.framework.observe(self.on.update_status, self._on_update_status)
+        self.framework.observe(self.on.query_archive_action, self._on_query_archive_action)
+        self.framework.observe(
+            self.on.benchmark_submission_action, self._on_benchmark_submission_action
+        )
         self.framework.observe(self.on.remove, self._on_remove)
+        self.framework.observe(self.framework.on.pre_commit, self._on_pre_commit)
 
     @property
     def _template_files(self):
@@ -80,11 +163,378 @@ class SparkCharm(CharmBase):
         context = {
             "app_name": self.model.app.name,
             "model_name": self.model.name,
+            "shuffle_service_enabled": self._shuffle_service_enabled,
+            "shuffle_service_image": self.model.config["spark-image"],
+            "shuffle_service_memory": self.model.config["shuffle-service-memory"],
+            "shuffle_service_port": self._shuffle_service_port,
+            "shuffle_dir": self._shuffle_dir,
+            "priority_classes": {},
+            "prepull_images": self._prepull_images,
+            "pause_image": self.model.config["pause-image"],
+            "ui_proxy_enabled": self.model.config["enable-ui-proxy"],
+            "ui_proxy_image": self.model.config["ui-proxy-image"],
+            # Looked up by the leader right before it applies the manifests
+            "ui_proxy_drivers": {},
+            "ui_ingress_host": self.model.config["ui-ingress-host"],
+            "ui_port": self.model.config["application-metrics-port"],
+            "slim_crds": self.model.config["slim-crd-schemas"],
+            "pushgateway_enabled": self.model.config["enable-pushgateway"],
+            "pushgateway_image": self.model.config["pushgateway-image"],
+            "pushgateway_port": self.model.config["pushgateway-port"],
+            "pushgateway_memory_limit": self.model.config["pushgateway-memory-limit"],
+            "pushgateway_go_memory_limit": "",
         }
+        try:
+            context["priority_classes"] = self._priority_classes
+            if self.model.config["enable-pushgateway"]:
+                context["pushgateway_go_memory_limit"] = self._pushgateway_go_memory_limit
+        except ErrorWithStatus as e:
+            # Surfaced when the resources are applied
+            log.warning(e.msg)
         return context
 
+    @property
+    def _pushgateway_go_memory_limit(self) -> str:
+        """GOMEMLIMIT of the Pushgateway, in bytes, 10% below its container memory limit.
+
+        Raises:
+            ErrorWithStatus: if pushgateway-memory-limit is not a memory quantity.
+        """
+        limit = self.model.config["pushgateway-memory-limit"]
+        match = re.fullmatch(r"(\d+)(Ki|Mi|Gi|k|M|G)?", limit)
+        if not match:
+            raise ErrorWithStatus(f"Invalid pushgateway-memory-limit: {limit}", BlockedStatus)
+        number, unit = match.groups()
+        factors = {
+            "Ki": 2**10,
+            "Mi": 2**20,
+            "Gi": 2**30,
+            "k": 10**3,
+            "M": 10**6,
+            "G": 10**9,
+        }
+        # Leaves the Go runtime room to collect garbage before the container is killed
+        return str(int(number) * factors.get(unit, 1) * 9 // 10)
+
+    @property
+    def _performance_profiles(self) -> dict:
+        """Named Spark configuration maps from the performance-profiles config.
+
+        The values are strings, as in the sparkConf of a SparkApplication.
+
+        Raises:
+            ErrorWithStatus: if the config is not a mapping of valid names to mappings.
+        """
+        try:
+            profiles = yaml.safe_load(self.model.config["performance-profiles"]) or {}
+        except yaml.YAMLError:
+            raise ErrorWithStatus("performance-profiles is not valid YAML", BlockedStatus)
+        if not isinstance(profiles, dict):
+            raise ErrorWithStatus("performance-profiles must be a mapping", BlockedStatus)
+        for name, conf in profiles.items():
+            if not re.fullmatch(r"[a-z0-9]([-a-z0-9]*[a-z0-9])?", str(name)):
+                raise ErrorWithStatus(f"Invalid performance profile name: {name}", BlockedStatus)
+            if not isinstance(conf, dict):
+                raise ErrorWithStatus(
+                    f"Performance profile {name} must be a mapping", BlockedStatus
+                )
+        return {
+            name: {key: str(value) for key, value in conf.items()}
+            for name, conf in profiles.items()
+        }
+
+    @property
+    def _priority_classes(self) -> dict:
+        """Priority tiers from the priority-classes config, mapped to their values.
+
+        Raises:
+            ErrorWithStatus: if the config is not a mapping of valid names to integers.
+        """
+        try:
+            tiers = yaml.safe_load(self.model.config["priority-classes"]) or {}
+        except yaml.YAMLError:
+            raise ErrorWithStatus("priority-classes is not valid YAML", BlockedStatus)
+        if not isinstance(tiers, dict):
+            raise ErrorWithStatus("priority-classes must be a mapping", BlockedStatus)
+        for name, value in tiers.items():
+            if not re.fullmatch(r"[a-z0-9]([-a-z0-9]*[a-z0-9])?", str(name)):
+                raise ErrorWithStatus(f"Invalid priority tier name: {name}", BlockedStatus)
+            if not isinstance(value, int) or isinstance(value, bool):
+                raise ErrorWithStatus(f"Priority of tier {name} must be an integer", BlockedStatus)
+        return tiers
+
+    def _priority_class_name(self, tier: str) -> str:
+        return f"{self.model.name}-{self.model.app.name}-{tier}"
+
+    @property
+    def _prepull_images(self) -> list:
+        return self.model.config["prepull-images"].replace(",", " ").split()
+
+    @property
+    def _shuffle_service_enabled(self) -> bool:
+        return self.model.config["dynamic-allocation"] == "external-shuffle-service"
+
+    @property
+    def _scrape_jobs(self) -> list:
+        jobs = [
+            {
+                "static_configs": [
+                    {
+                        "targets": ["*:8080"],
+                    }
+                ],
+            }
+        ]
+        if self.model.config["enable-pushgateway"]:
+            jobs.append(
+                {
+                    "job_name": "pushgateway",
+                    "static_configs": [
+                        {
+                            "targets": [
+                                f"{self._pushgateway_name}.{self.model.name}.svc:"
+                                f"{self.model.config['pushgateway-port']}"
+                            ]
+                        }
+                    ],
+                }
+            )
+        return jobs
+
+    @property
+    def _spark_defaults(self) -> dict:
+        """Spark configuration applied by default to every submitted SparkApplication.
+
+        Properties set in the sparkConf of a SparkApplication take precedence.
+        """
+        defaults = {}
+        if self.model.config["enable-application-metrics"]:
+            defaults.update(
+                {
+                    "spark.ui.prometheus.enabled": "true",
+                    "spark.metrics.appStatusSource.enabled": "true",
+                    "spark.executor.processTreeMetrics.enabled": "true",
+                    "spark.metrics.conf.*.sink.prometheusServlet.class": (
+                        "org.apache.spark.metrics.sink.PrometheusServlet"
+                    ),
+                    "spark.metrics.conf.*.sink.prometheusServlet.path": "/metrics/prometheus",
+                }
+            )
+        defaults.update(self._dynamic_allocation_defaults)
+        defaults.update(self._scratch_space_defaults)
+
+        policy = self.model.config["placement-policy"]
+        if policy not in self._placement_policies:
+            raise ErrorWithStatus(f"Invalid placement-policy: {policy}", BlockedStatus)
+        tier = self.model.config["default-priority-tier"]
+        if tier and tier not in self._priority_classes:
+            raise ErrorWithStatus(f"Unknown default-priority-tier: {tier}", BlockedStatus)
+        for role in ("driver", "executor"):
+            defaults[f"spark.kubernetes.{role}.podTemplateFile"] = self._pod_template_file(
+                role, policy, tier
+            )
+        if self._history_server_enabled:
+            defaults.update(
+                {
+                    "spark.eventLog.enabled": "true",
+                    "spark.eventLog.dir": self.model.config["event-log-dir"],
+                    "spark.eventLog.compress": "true",
+                    "spark.eventLog.rolling.enabled": "true",
+                    "spark.eventLog.rolling.maxFileSize": self.model.config[
+                        "event-log-rolling-max-file-size"
+                    ],
+                }
+            )
+        if self.model.config["enable-pushgateway"]:
+            defaults.update(
+                {
+                    "spark.kubernetes.driverEnv.PUSHGATEWAY_URL": self._pushgateway_url,
+                    "spark.executorEnv.PUSHGATEWAY_URL": self._pushgateway_url,
+                }
+            )
+        return defaults
+
+    @property
+    def _dynamic_allocation_defaults(self) -> dict:
+        """Spark configuration enabling dynamic allocation of executors."""
+        mode = self.model.config["dynamic-allocation"]
+        if not mode:
+            return {}
+        if mode not in ("shuffle-tracking", "external-shuffle-service"):
+            raise ErrorWithStatus(f"Invalid dynamic-allocation mode: {mode}", BlockedStatus)
+
+        defaults = {
+            "spark.dynamicAllocation.enabled": "true",
+            "spark.dynamicAllocation.minExecutors": "0",
+            "spark.dynamicAllocation.maxExecutors": self.model.config[
+                "dynamic-allocation-max-executors"
+            ],
+            "spark.dynamicAllocation.executorIdleTimeout": "60s",
+        }
+        if mode == "shuffle-tracking":
+            defaults["spark.dynamicAllocation.shuffleTracking.enabled"] = "true"
+        elif mode == "external-shuffle-service":
+            volume = "spark.kubernetes.executor.volumes.hostPath.spark-local-dir-shuffle"
+            defaults.update(
+                {
+                    "spark.shuffle.service.enabled": "true",
+                    "spark.shuffle.service.port": self._shuffle_service_port,
+                    f"{volume}.mount.path": self._shuffle_dir,
+                    f"{volume}.options.path": self._shuffle_dir,
+                }
+            )
+        return defaults
+
+    @property
+    def _scratch_space_defaults(self) -> dict:
+        """Spark configuration mounting scratch space into drivers and executors.
+
+        Volumes named spark-local-dir-* are used by Spark as spark.local.dir.
+        """
+        kind = self.model.config["scratch-space"]
+        size = self.model.config["scratch-space-size"]
+        if not kind:
+            return {}
+
+        if kind in ("tmpfs", "disk"):
+            volume_type, options = "emptyDir", {}
+            if kind == "tmpfs":
+                options["medium"] = "Memory"
+            if size:
+                options["sizeLimit"] = size
+        elif kind == "pvc":
+            volume_type, options = "persistentVolumeClaim", {"claimName": "OnDemand"}
+            if self.model.config["scratch-space-storage-class"]:
+                options["storageClass"] = self.model.config["scratch-space-storage-class"]
+            options["sizeLimit"] = size or "10Gi"
+        else:
+            raise ErrorWithStatus(f"Invalid scratch-space: {kind}", BlockedStatus)
+
+        defaults = {}
+        # Spark spreads shuffle files over all local dirs, while the external shuffle service
+        # only serves the ones in the shared shuffle dir of the node
+        roles = ("driver",) if self._shuffle_service_enabled else ("driver", "executor")
+        for role in roles:
+            volume = f"spark.kubernetes.{role}.volumes.{volume_type}.spark-local-dir-scratch"
+            defaults[f"{volume}.mount.path"] = self._scratch_dir
+            defaults[f"{volume}.mount.readOnly"] = "false"
+            for option, value in options.items():
+                defaults[f"{volume}.options.{option}"] = value
+        return defaults
+
+    def _pod_template_file(self, role: str, policy: str, tier: str) -> str:
+        """Path in spark container of the pod template for a role, placement and priority.
+
+        An application picks a placement policy or priority tier other than the
+        configured defaults by setting spark.kubernetes.{driver,executor}.podTemplateFile
+        to the matching file.
+        """
+        return f"{self._pod_templates_dir}/{policy or 'default'}/{tier or 'default'}/{role}.yaml"
+
+    def _pod_template(self, role: str, policy: str, tier: str) -> dict:
+        """Pod template applied by spark-submit to driver or executor pods."""
+        metadata = {
+            "labels": {
+                "spark-k8s.charm/placement": policy or "default",
+                "spark-k8s.charm/priority-tier": tier or "default",
+            }
+        }
+        if role == "driver" and self.model.config["enable-application-metrics"]:
+            # Drivers come and go with their applications, beyond what the static targets of
+            # the metrics-endpoint relation can describe. Pod discovery picks them up by these.
+            metadata["annotations"] = {
+                "prometheus.io/scrape": "true",
+                "prometheus.io/port": str(self.model.config["application-metrics-port"]),
+                "prometheus.io/path": "/metrics/prometheus/",
+            }
+        spec = {}
+        if tier:
+            spec["priorityClassName"] = self._priority_class_name(tier)
+        if role == "executor" and self._shuffle_service_enabled:
+            # Executors must reach the shuffle service listening on their node
+            spec.update({"hostNetwork": True, "dnsPolicy": "ClusterFirstWithHostNet"})
+
+        same_policy = {"matchLabels": {"spark-role": role, "spark-k8s.charm/placement": policy}}
+        if policy == "bin-pack":
+            # Fill the nodes already running Spark pods before using new ones
+            if self.model.config["bin-pack-scheduler-name"]:
+                spec["schedulerName"] = self.model.config["bin-pack-scheduler-name"]
+            spec["affinity"] = {
+                "podAffinity": {
+                    "preferredDuringSchedulingIgnoredDuringExecution": [
+                        {
+                            "weight": 100,
+                            "podAffinityTerm": {
+                                "labelSelector": {
+                                    "matchLabels": {"spark-k8s.charm/placement": policy}
+                                },
+                                "topologyKey": "kubernetes.io/hostname",
+                            },
+                        }
+                    ]
+                }
+            }
+        elif policy == "spread":
+            # Spread pods of the same role over nodes for network and disk bandwidth
+            spec["topologySpreadConstraints"] = [
+                {
+                    "maxSkew": 1,
+                    "topologyKey": "kubernetes.io/hostname",
+                    "whenUnsatisfiable": "ScheduleAnyway",
+                    "labelSelector": same_policy,
+                }
+            ]
+        return {"apiVersion": "v1", "kind": "Pod", "metadata": metadata, "spec": spec}
+
+    @property
+    def _pushgateway_url(self) -> str:
+        """Address of the Pushgateway Service."""
+        return (
+            f"http://{self._pushgateway_name}.{self.model.name}.svc:"
+            f"{self.model.config['pushgateway-port']}"
+        )
+
+    @property
+    def _metrics_flags(self) -> str:
+        """Operator flags for metrics labels and job start latency buckets.
+
+        Raises:
+            ErrorWithStatus: if a label name or bucket boundary is invalid.
+        """
+        flags = ""
+        labels = [label.strip() for label in self.model.config["metrics-labels"].split(",")]
+        for label in filter(None, labels):
+            if not re.fullmatch(r"[a-zA-Z_][a-zA-Z0-9_]*", label):
+                raise ErrorWithStatus(f"Invalid metrics label: {label}", BlockedStatus)
+            flags += f"-metrics-labels={label} "
+
+        buckets = self.model.config["metrics-job-start-latency-buckets"].strip()
+        if buckets:
+            try:
+                bounds = [float(bound) for bound in buckets.split(",")]
+            except ValueError:
+                raise ErrorWithStatus(f"Invalid latency buckets: {buckets}", BlockedStatus)
+            if bounds != sorted(set(bounds)):
+                raise ErrorWithStatus("Latency buckets must be strictly increasing", BlockedStatus)
+            flags += f"-metrics-job-start-latency-buckets={','.join(map(str, bounds))} "
+        return flags
+
+    @property
+    def _leader_election_flags(self) -> str:
+        """Operator flags electing the one unit that runs the controller.
+
+        Every operator serves the webhook, which the Service spreads across the units, the
+        controller only runs on the elected one. The election also works with a single unit.
+        """
+        return (
+            "-leader-election=true "
+            f"-leader-election-lock-namespace={self.model.name} "
+            f"-leader-election-lock-name={self.model.app.name}-lock "
+        )
+
     @property
     def _spark_operator_layer(self) -> Layer:
+        ui_service = str(self.model.config["enable-ui-service"]).lower()
         pebble_layer = {
             "summary": "spark layer",
             "description": "pebble config layer for spark-k8s",
@@ -97,12 +547,13 @@ class SparkCharm(CharmBase):
                         f"/usr/bin/tini -s -- /usr/bin/spark-operator -v=2 "
                         "-logtostderr "
                         f"-namespace={self.model.name} "
-                        "-enable-ui-service=true "
+                        f"-enable-ui-service={ui_service} "
                         "-controller-threads=10 "
                         "-resync-interval=30 "
                         "-enable-batch-scheduler=false "
+                        f"{self._leader_election_flags}"
                         "-enable-metrics=true "
-                        "-metrics-labels=app_type "
+                        f"{self._metrics_flags}"
                         f"-metrics-port={self.model.config['metrics-port']} "
                         "-metrics-endpoint=/metrics "
                         "-enable-resource-quota-enforcement=false "
@@ -114,27 +565,177 @@ class SparkCharm(CharmBase):
                         f"-webhook-namespace-selector=model.juju.is/name={self.model.name} "
                         "-webhook-fail-on-error=true"
                     ),
+                    "on-check-failure": {
+                        "operator-metrics": "restart",
+                        "operator-webhook": "restart",
+                    },
                 }
             },
+            "checks": {
+                "operator-metrics": {
+                    "override": "replace",
+                    "level": "alive",
+                    "period": "10s",
+                    "threshold": 3,
+                    "http": {
+                        "url": f"http://localhost:{self.model.config['metrics-port']}/metrics"
+                    },
+                },
+                "operator-webhook": {
+                    "override": "replace",
+                    "level": "alive",
+                    "period": "10s",
+                    "threshold": 3,
+                    "tcp": {"port": int(self.model.config["webhook-port"])},
+                },
+            },
+        }
+        # Optional services are always declared so that turning them off disables them
+        pebble_layer["services"]["history-server"] = {
+            "override": "replace",
+            "summary": "Spark History Server",
+            "startup": "enabled" if self._history_server_enabled else "disabled",
+            "command": (
+                "/opt/spark/bin/spark-class org.apache.spark.deploy.history.HistoryServer"
+            ),
+            "environment": {
+                "SPARK_DAEMON_MEMORY": self.model.config["history-server-memory"],
+                "SPARK_HISTORY_OPTS": " ".join(
+                    f"-D{key}={value}" for key, value in sorted(self._history_server_conf.items())
+                ),
+            },
         }
         return Layer(pebble_layer)
 
+    @property
+    def _history_server_enabled(self) -> bool:
+        """Whether the History Server runs.
+
+        It needs the optional spark-history storage for its store, and an event log dir that
+        drivers write to, since they cannot reach the storage of the charm.
+        """
+        return bool(
+            self.model.config["enable-history-server"]
+            and self.model.config["event-log-dir"]
+            and self.model.storages["spark-history"]
+        )
+
+    @property
+    def _history_server_conf(self) -> dict:
+        """Spark configuration of the History Server.
+
+        Application data is kept in a disk store on the spark-history storage, so that
+        memory use depends on the number of retained applications rather than the number
+        of event logs.
+        """
+        return {
+            "spark.history.ui.port": self.model.config["history-server-port"],
+            "spark.history.fs.logDirectory": self.model.config["event-log-dir"],
+            "spark.history.store.path": f"{self._history_storage_dir}/store",
+            "spark.history.store.maxDiskUsage": self.model.config["history-server-max-disk-usage"],
+            "spark.history.retainedApplications": self.model.config[
+                "history-server-retained-applications"
+            ],
+            "spark.history.fs.eventLog.rolling.maxFilesToRetain": self.model.config[
+                "event-log-max-files-to-retain"
+            ],
+            "spark.history.fs.cleaner.enabled": "true",
+            "spark.history.fs.cleaner.maxAge": self.model.config["event-log-max-age"],
+        }
+
     def _update_layer(self) -> None:
         """Updates the Pebble configuration layer if changed."""
 
-        current_layer = self.container.get_plan()
-        new_layer = self._spark_operator_layer
+        with self.charm_metrics.timer("update_layer"):
+            current_layer = self.container.get_plan()
+            new_layer = self._spark_operator_layer
 
-        if current_layer.services != new_layer.services:
-            self.container.add_layer(self._container_name, new_layer, combine=True)
-            try:
-                log.info("Pebble plan updated with new configuration, replanning")
-                self.container.replan()
-            except ChangeError as e:
-                log.error(traceback.format_exc())
-                self.unit.status = BlockedStatus("Failed to replan")
-                raise e
-                return
+            # The checks only depend on ports that are part of the service command
+            if current_layer.services != new_layer.services:
+                self.container.add_layer(self._container_name, new_layer, combine=True)
+                try:
+                    log.info("Pebble plan updated with new configuration, replanning")
+                    self.container.replan()
+                    self._stored.operator_started_at = time.time()
+                    self._stop_disabled_services(new_layer)
+                except ChangeError as e:
+                    log.error(traceback.format_exc())
+                    self.unit.status = BlockedStatus("Failed to replan")
+                    raise e
+
+    def _stop_disabled_services(self, layer: Layer) -> None:
+        """Stop running services that the layer declares as disabled."""
+        disabled = [
+            name for name, service in layer.services.items() if service.startup == "disabled"
+        ]
+        running = [
+            name
+            for name, info in self.container.get_services(*disabled).items()
+            if info.is_running()
+        ]
+        if running:
+            self.container.stop(*running)
+
+    def _update_certs(self) -> None:
+        """Generate the webhook certs on first use, and again when the key algorithm changes.
+
+        Only the leader generates them, the other units take the ones it shares, so that all
+        units serving the webhook behind the Service present the same CA.
+        """
+        self._receive_certs()
+        if not self.unit.is_leader():
+            return
+        # Certs generated before the key algorithm was configurable are RSA
+        current = self._stored.key_algorithm or ("rsa-2048" if self._stored.cert else "")
+        algorithm = self.model.config["webhook-key-algorithm"] or current or "ecdsa-p256"
+        if algorithm not in KEY_ALGORITHMS:
+            # Surfaced when the spark container is updated
+            algorithm = current or "ecdsa-p256"
+        if algorithm == current:
+            return
+        log.info(f"Generating {algorithm} webhook certs")
+        with self.charm_metrics.timer("gen_certs"):
+            certs = self.gen_certs(algorithm)
+        self._stored.cert = certs["cert"]
+        self._stored.key = certs["key"]
+        self._stored.ca = certs["ca"]
+        self._stored.key_algorithm = algorithm
+        self._certs_rotated = bool(current)
+
+    def _receive_certs(self) -> None:
+        """Take the webhook certs shared by the leader in the replicas relation, if new."""
+        relation = self.model.get_relation("replicas")
+        if relation is None:
+            return
+        shared = relation.data[self.app]
+        if not shared.get("cert") or shared["cert"] == self._stored.cert:
+            return
+        log.info("Taking the webhook certs shared by the leader")
+        rotated = bool(self._stored.cert)
+        self._stored.cert = shared["cert"]
+        self._stored.key = shared["key"]
+        self._stored.ca = shared["ca"]
+        self._stored.key_algorithm = shared["key-algorithm"]
+        self._certs_rotated = rotated
+
+    def _sync_certs(self) -> None:
+        """Share the webhook certs of the leader with the other units, or take the shared ones."""
+        if not self.unit.is_leader():
+            self._receive_certs()
+            return
+        relation = self.model.get_relation("replicas")
+        if relation is None:
+            return
+        certs = {
+            "cert": self._stored.cert,
+            "key": self._stored.key,
+            "ca": self._stored.ca,
+            "key-algorithm": self._stored.key_algorithm,
+        }
+        databag = relation.data[self.app]
+        for key, value in certs.items():
+            if databag.get(key) != value:
+                databag[key] = value
 
     def _update_webhook_certs(self) -> None:
         """Push keys and certs files into spark container"""
@@ -151,28 +752,275 @@ class SparkCharm(CharmBase):
             log.error(str(e))
             self.unit.status = BlockedStatus(str(e))
 
-    def _update_spark_container(self, event) -> None:
+    def _update_spark_defaults(self) -> None:
+        """Push spark-defaults.conf and pod templates used by spark-submit into spark container"""
+        spark_defaults = "".join(
+            f"{key} {value}\n" for key, value in sorted(self._spark_defaults.items())
+        )
+        try:
+            self.container.push(self._spark_defaults_file, spark_defaults, make_dirs=True)
+            for policy in self._placement_policies:
+                for tier in ["", *self._priority_classes]:
+                    for role in ("driver", "executor"):
+                        self.container.push(
+                            self._pod_template_file(role, policy, tier),
+                            yaml.safe_dump(self._pod_template(role, policy, tier)),
+                            make_dirs=True,
+                        )
+            log.info("Pushed spark defaults to spark container")
+        except (ProtocolError, PathError) as e:
+            log.error(str(e))
+            self.unit.status = BlockedStatus(str(e))
+
+    def _update_history_storage(self) -> None:
+        """Create the store directory of the History Server."""
+        if not self._history_server_enabled:
+            return
+        try:
+            self.container.make_dir(f"{self._history_storage_dir}/store", make_parents=True)
+        except (ProtocolError, PathError) as e:
+            log.error(str(e))
+            self.unit.status = BlockedStatus(str(e))
+
+    def _update_spark_container(self) -> None:
         if not self.container.can_connect():
+            # Reconciled again on spark-pebble-ready
             self.unit.status = WaitingStatus("Waiting to connect to spark container")
-            event.defer()
+            return
+        if not self._stored.cert:
+            # Reconciled again when the leader shares them in the replicas relation
+            self.unit.status = WaitingStatus("Waiting for the webhook certs from the leader")
             return
 
         self.unit.status = MaintenanceStatus("Configuring Spark Charm")
 
         self._update_webhook_certs()
-        self._update_layer()
+        self._update_history_storage()
+        try:
+            if self.model.config["webhook-key-algorithm"] not in ("", *KEY_ALGORITHMS):
+                raise ErrorWithStatus(
+                    f"webhook-key-algorithm must be one of {', '.join(KEY_ALGORITHMS)}",
+                    BlockedStatus,
+                )
+            # Surfaces invalid profiles, which are handed out over the spark relation
+            self._performance_profiles
+            self._update_spark_defaults()
+            # Also stops a History Server that is missing what it needs
+            self._update_layer()
+            if self.model.config["enable-history-server"] and not self._history_server_enabled:
+                # It would never show an application
+                if not self.model.config["event-log-dir"]:
+                    raise ErrorWithStatus(
+                        "Set event-log-dir to run the History Server", BlockedStatus
+                    )
+                raise ErrorWithStatus(
+                    "Add spark-history storage to run the History Server", BlockedStatus
+                )
+        except ErrorWithStatus as e:
+            log.error(e.msg)
+            self.unit.status = e.status
+            return
+        if self._certs_rotated:
+            # The operator only reads its certs, and registers the CA bundle, on start
+            log.info("Webhook certs rotated, restarting the operator")
+            self.container.restart(self._container_name)
+            self._stored.operator_started_at = time.time()
+            self._certs_rotated = False
+
+        self._update_readiness()
+
+    def _operator_ready(self) -> bool:
+        """Whether the operator serves its metrics and accepts webhook connections."""
+        try:
+            with urlopen(
+                f"http://localhost:{self.model.config['metrics-port']}/metrics", timeout=2
+            ):
+                pass
+            with socket.create_connection(
+                ("localhost", int(self.model.config["webhook-port"])), 2
+            ):
+                pass
+        except OSError:
+            return False
+        return True
+
+    def _update_readiness(self) -> None:
+        """Set the unit status from the readiness of the operator.
 
+        Until `_ready_timeout` after the operator was (re)started, wait for it. Record the time
+        it took to become ready.
+        """
+        started_at = self._stored.operator_started_at
+        deadline = started_at + self._ready_timeout
+        while not self._operator_ready():
+            if time.time() >= deadline:
+                self.unit.status = WaitingStatus("Waiting for the operator to become ready")
+                return
+            time.sleep(1)
+        if started_at:
+            self.charm_metrics.observe("time_to_ready", time.time() - started_at)
+            self._stored.operator_started_at = 0.0
+        self._update_webhook_config()
         self.unit.status = ActiveStatus()
 
-    def _on_install(self, _):
-        """Event Handler for install event."""
-        self.unit.status = MaintenanceStatus("Configuring/deploying resources")
+    @property
+    def _mutating_webhook_config(self) -> MutatingWebhookConfiguration:
+        """The webhook configuration as the operator registers it, restricted to Spark pods."""
+        return MutatingWebhookConfiguration.from_dict(
+            {
+                "metadata": {"name": self._mutating_webhook_name},
+                "webhooks": [
+                    {
+                        "name": "webhook.sparkoperator.k8s.io",
+                        "admissionReviewVersions": ["v1"],
+                        "clientConfig": {
+                            "service": {
+                                "name": self.model.app.name,
+                                "namespace": self.model.name,
+                                "path": "/webhook",
+                                "port": int(self.model.config["webhook-port"]),
+                            },
+                            "caBundle": base64.b64encode(self._stored.ca.encode()).decode(),
+                        },
+                        "rules": [
+                            {
+                                "operations": ["CREATE"],
+                                "apiGroups": [""],
+                                "apiVersions": ["v1"],
+                                "resources": ["pods"],
+                            }
+                        ],
+                        "failurePolicy": "Fail",
+                        "sideEffects": "None",
+                        "timeoutSeconds": 30,
+                        "namespaceSelector": {
+                            "matchLabels": {"model.juju.is/name": self.model.name}
+                        },
+                        "objectSelector": self._webhook_object_selector,
+                    }
+                ],
+            }
+        )
+
+    def _update_webhook_config(self) -> None:
+        """Restore the webhook configuration the operator registers, and restrict it to Spark pods.
+
+        The operator only scopes it by namespace, registers it again whenever it starts and
+        deletes it when it stops, even while the operators of other units still serve the
+        webhook. So this is checked whenever the operator is found ready.
+        """
+        try:
+            try:
+                config = self.lightkube_client.get(
+                    MutatingWebhookConfiguration, self._mutating_webhook_name
+                )
+            except ApiError as e:
+                if e.status.code != 404:
+                    raise
+                self.lightkube_client.create(self._mutating_webhook_config)
+                log.info("Registered the webhook removed by a stopped operator")
+                return
+            webhooks = [
+                {"name": webhook.name, "objectSelector": self._webhook_object_selector}
+                for webhook in config.webhooks or []
+                if webhook.objectSelector is None
+                or webhook.objectSelector.to_dict() != self._webhook_object_selector
+            ]
+            if webhooks:
+                self.lightkube_client.patch(
+                    MutatingWebhookConfiguration,
+                    self._mutating_webhook_name,
+                    {"webhooks": webhooks},
+                )
+                log.info("Restricted the webhook to Spark pods")
+        except ApiError as e:
+            log.warning(f"Failed to update the webhook configuration: {e}")
+
+    def _reconcile(self, event):
+        """Bring the containers, resources and relations in line with the charm and its config.
+
+        This handles every event that can change what should be deployed. Each step is
+        idempotent and skips what is already up to date: manifests are only applied if they
+        changed since they were last applied, and the operator is only replanned if its layer
+        changed, so that the webhook keeps serving. Containers that cannot be reached yet are
+        picked up on their pebble-ready event rather than by deferring.
+        """
+        with self.charm_metrics.timer("reconcile"):
+            self._patch_service_ports(event)
+            self.metrics_endpoint._set_scrape_job_spec(event)
+            self._update_spark_relation(event)
+            self._sync_certs()
+            self._update_spark_container()
+            # A fresh install also repairs resources left over by a previous deployment
+            self._apply_resources(only_changed=not isinstance(event, InstallEvent))
+
+    def _patch_service_ports(self, event) -> None:
+        """Patch the ports of the charm Service, if they changed."""
+        ports = json.dumps(
+            sorted((port.name, port.port) for port in self.service_patcher.service.spec.ports)
+        )
+        if ports == self._stored.service_ports:
+            return
+        # The service patcher patches on install and upgrade-charm by itself
+        if not isinstance(event, (InstallEvent, UpgradeCharmEvent)):
+            self.service_patcher._patch(event)
+        # The patcher logs failures, such as a missing `juju trust`, instead of raising
+        try:
+            patched = self.service_patcher.is_patched()
+        except (ApiError, ConfigError) as e:
+            log.warning(f"Failed to check the ports of the charm Service: {e}")
+            return
+        if patched:
+            self._stored.service_ports = ports
+
+    def _apply_resources(self, only_changed: bool = False) -> bool:
+        """Apply the rendered manifests and delete the ones of disabled features.
 
-        if self.container.can_connect():
-            self._update_webhook_certs()
+        Args:
+            only_changed: only apply the manifests that differ from the ones last applied
 
+        Returns:
+            True if the resources were applied, False if the unit was blocked.
+        """
         try:
-            self.resource_handler.apply()
+            tiers = self._priority_classes
+            if self.model.config["enable-pushgateway"]:
+                self._pushgateway_go_memory_limit
+            if not self.unit.is_leader():
+                # The resources are shared by all units of the application
+                return True
+            if self.model.config["enable-ui-proxy"]:
+                self.resource_handler.context = {
+                    **self._context,
+                    "ui_proxy_drivers": self._ui_proxy_drivers,
+                }
+            with self.charm_metrics.timer("apply"):
+                manifests = self.resource_handler.render_manifests(force_recompute=False)
+                hashes = self._manifest_hashes(manifests)
+                applied = dict(self._stored.applied_manifests)
+                if only_changed:
+                    changed = [
+                        manifest
+                        for manifest in manifests
+                        if applied.get(self._manifest_key(manifest))
+                        != hashes[self._manifest_key(manifest)]
+                    ]
+                    log.info(f"Applying {len(changed)} of {len(manifests)} manifests")
+                    apply_many(
+                        client=self.resource_handler.lightkube_client,
+                        objs=changed,
+                        field_manager=self.model.app.name,
+                        force=True,
+                    )
+                else:
+                    self.resource_handler.apply()
+            # Disabled features and pruned tiers would have changed the manifests
+            if not only_changed or hashes != applied:
+                for resource, name in self._disabled_resources:
+                    self._delete_if_exists(resource, name)
+                self._prune_priority_classes(tiers)
+            # Only recorded once everything succeeded, so that a failed step is retried
+            self._stored.applied_manifests = hashes
         except (ApiError, ErrorWithStatus) as e:
             if isinstance(e, ApiError):
                 log.error(f"Applying resources failed with ApiError status code {e.status.code}")
@@ -180,126 +1028,362 @@ class SparkCharm(CharmBase):
             else:
                 log.info(e.msg)
                 self.unit.status = e.status
-        else:
-            self.unit.status = ActiveStatus()
+            return False
+        return True
+
+    @staticmethod
+    def _manifest_key(manifest) -> str:
+        return f"{manifest.kind}/{manifest.metadata.namespace or ''}/{manifest.metadata.name}"
+
+    def _manifest_hashes(self, manifests: list) -> dict:
+        """Digests of the manifests, keyed by their kind, namespace and name."""
+        return {
+            self._manifest_key(manifest): hashlib.sha256(
+                json.dumps(manifest.to_dict(), sort_keys=True).encode()
+            ).hexdigest()
+            for manifest in manifests
+        }
+
+    @property
+    def _disabled_resources(self) -> list:
+        """Resources of features turned off in the config, as (resource, name) pairs."""
+        app = self.model.app.name
+        resources = []
+        if not self._shuffle_service_enabled:
+            resources.append((DaemonSet, self._shuffle_service_name))
+        if not self._prepull_images:
+            resources.append((DaemonSet, self._prepull_name))
+        if not self.model.config["enable-ui-proxy"]:
+            resources += [
+                (Deployment, f"{app}-ui-proxy"),
+                (Service, f"{app}-ui-proxy"),
+                (ConfigMap, f"{app}-ui-proxy"),
+            ]
+        if not self.model.config["enable-pushgateway"]:
+            resources += [
+                (Deployment, self._pushgateway_name),
+                (Service, self._pushgateway_name),
+            ]
+        if not self.model.config["enable-ui-proxy"] or not self.model.config["ui-ingress-host"]:
+            resources.append((Ingress, f"{app}-ui-proxy"))
+        return resources
+
+    def _prune_priority_classes(self, tiers: dict) -> None:
+        """Delete the PriorityClasses of tiers no longer in the config."""
+        selector = operators.not_in(list(tiers)) if tiers else operators.exists()
+        # PriorityClasses are cluster-wide, only touch the ones of this application and model
+        for priority_class in self.lightkube_client.list(
+            PriorityClass,
+            labels={
+                "spark-k8s.charm/priority-tier": selector,
+                "app.juju.is/created-by": self.model.app.name,
+                "spark-k8s.charm/model": self.model.name,
+            },
+        ):
+            self._delete_if_exists(PriorityClass, priority_class.metadata.name)
+
+    def _delete_if_exists(self, resource, name: str) -> None:
+        """Delete a resource, ignoring it if already gone."""
+        try:
+            self.lightkube_client.delete(resource, name)
+        except ApiError as e:
+            if e.status.code != 404:
+                raise
+
+    @property
+    def _spark_relation_data(self) -> dict:
+        """Submission settings handed out over the spark relation.
+
+        Bump `version` when the meaning of existing keys changes. Version 2 hands out the
+        Spark configuration of every profile, which clients merge into the sparkConf of the
+        applications they submit, instead of names of ConfigMaps.
+        """
+        try:
+            profiles = self._performance_profiles
+        except ErrorWithStatus:
+            profiles = {}
+        return {
+            "version": "2",
+            "namespace": self.model.name,
+            "service-account": f"{self.model.app.name}-driver-account",
+            "image": self.model.config["spark-image"],
+            "profiles": json.dumps(profiles, sort_keys=True),
+            "quotas": json.dumps(self._resource_quotas, sort_keys=True),
+        }
+
+    @property
+    def _ui_proxy_drivers(self) -> dict:
+        """Pod IPs of the running drivers, by the name of their SparkApplication."""
+        if not self.model.config["enable-ui-proxy"]:
+            return {}
+        try:
+            pods = self.lightkube_client.list(
+                Pod,
+                labels={
+                    "spark-role": "driver",
+                    "sparkoperator.k8s.io/launched-by-spark-operator": "true",
+                },
+                fields={"status.phase": "Running"},
+            )
+            return {
+                pod.metadata.labels["sparkoperator.k8s.io/app-name"]: pod.status.podIP
+                for pod in sorted(pods, key=lambda pod: pod.metadata.name)
+                if pod.metadata.labels.get("sparkoperator.k8s.io/app-name") and pod.status.podIP
+            }
+        except ApiError as e:
+            log.warning(f"Failed to list driver pods: {e}")
+            return {}
+
+    @property
+    def _resource_quotas(self) -> dict:
+        """Hard limits of the ResourceQuotas in the namespace, by quota name."""
+        try:
+            return {
+                quota.metadata.name: quota.spec.hard or {}
+                for quota in self.lightkube_client.list(ResourceQuota)
+            }
+        except ApiError as e:
+            log.warning(f"Failed to list resource quotas: {e}")
+            return {}
+
+    def _update_spark_relation(self, _):
+        """Publish submission settings to every spark relation, writing only changed keys."""
+        if not self.unit.is_leader():
+            return
+        relations = self.model.relations["spark"]
+        if not relations:
+            return
 
-    def _on_spark_pebble_ready(self, event):
-        """Event Handler for spark pebble ready event."""
-        self._update_spark_container(event)
+        data = self._spark_relation_data
+        for relation in relations:
+            databag = relation.data[self.app]
+            for key, value in data.items():
+                if databag.get(key) != value:
+                    databag[key] = value
+
+    def _on_update_status(self, _):
+        """Event Handler for update status event."""
+        if self.container.can_connect() and not isinstance(self.unit.status, BlockedStatus):
+            self._update_readiness()
+        self._report_prepull_progress()
+        self._prune_applications()
+        if self.model.config["enable-ui-proxy"] and self.unit.is_leader():
+            # Picks up the drivers started and stopped since the last event
+            self._apply_resources(only_changed=True)
+        if not self.model.config["enable-pushgateway"] or not self.unit.is_leader():
+            return
+        try:
+            evict_stale_groups(
+                self._pushgateway_url,
+                self.model.config["pushgateway-group-ttl"],
+            )
+        except OSError as e:
+            log.warning(f"Failed to evict stale Pushgateway groups: {e}")
+
+    @property
+    def _archive(self) -> Optional[ApplicationArchive]:
+        """Archive of pruned applications on the archive storage, if attached."""
+        storages = self.model.storages["archive"]
+        if not storages:
+            return None
+        return ApplicationArchive(Path(storages[0].location) / "applications.db")
+
+    def _prune_applications(self) -> None:
+        """Archive and delete SparkApplications that finished longer than the TTL ago."""
+        ttl = self.model.config["application-ttl"]
+        if not ttl or not self.unit.is_leader():
+            return
+        archive = self._archive
+        if archive is None:
+            log.warning("Archive storage not attached, not pruning SparkApplications")
+            return
+
+        now = time.time()
+        pruned = 0
+        try:
+            for app in self.lightkube_client.list(SparkApplication, chunk_size=500):
+                record = application_record(app)
+                if record is None or now - record["termination_time"] < ttl:
+                    continue
+                # Only delete once the record is safely stored
+                archive.add(record)
+                self._delete_if_exists(SparkApplication, app.metadata.name)
+                pruned += 1
+                if pruned >= self._prune_batch_size:
+                    break
+        except ApiError as e:
+            log.warning(f"Failed to prune SparkApplications: {e}")
+        finally:
+            archive.close()
+        if pruned:
+            log.info(f"Archived and deleted {pruned} finished SparkApplications")
+
+    def _on_query_archive_action(self, event):
+        """Event Handler for query-archive action."""
+        archive = self._archive
+        if archive is None:
+            event.fail("Archive storage not attached")
+            return
+        try:
+            records = archive.query(
+                name=event.params.get("name"),
+                since=parse_time(event.params.get("since")),
+                until=parse_time(event.params.get("until")),
+                limit=event.params.get("limit", 50),
+            )
+        except ValueError as e:
+            event.fail(f"Invalid time: {e}")
+            return
+        finally:
+            archive.close()
+        event.set_results({"count": len(records), "records": json.dumps(records)})
+
+    def _on_benchmark_submission_action(self, event):
+        """Event Handler for benchmark-submission action."""
+        manifest = yaml.safe_load((self.charm_dir / "examples/spark-pi.yaml").read_text())
+        manifest["spec"]["driver"]["serviceAccount"] = f"{self.app.name}-driver-account"
+        profile = event.params.get("profile")
+        if profile:
+            try:
+                manifest = with_profile(manifest, self._performance_profiles[profile])
+            except (ErrorWithStatus, KeyError):
+                event.fail(f"Unknown performance profile: {profile}")
+                return
+        benchmark = SubmissionBenchmark(self.lightkube_client, manifest, self.model.name)
+        event.log(f"Submitting {event.params['count']} applications as run {benchmark.run_id}")
+        try:
+            try:
+                results = benchmark.run(
+                    count=event.params["count"],
+                    concurrency=event.params["concurrency"],
+                    timeout=event.params["timeout"],
+                )
+            finally:
+                # Also deletes the applications submitted before a failure
+                if event.params["cleanup"]:
+                    benchmark.cleanup()
+        except ApiError as e:
+            event.fail(f"Benchmark run {benchmark.run_id} failed: {e}")
+            return
+        event.set_results({"run-id": benchmark.run_id, **results})
 
-    def _on_config_changed(self, event):
-        """Event Handler for config changed event."""
-        self._update_spark_container(event)
+    def _report_prepull_progress(self) -> None:
+        """Show in the status message on how many nodes the Spark images are pulled."""
+        if not self._prepull_images or not isinstance(self.unit.status, ActiveStatus):
+            return
+        try:
+            status = self.lightkube_client.get(DaemonSet, self._prepull_name).status
+        except ApiError as e:
+            log.warning(f"Failed to get image pre-pull status: {e}")
+            return
+        ready, desired = status.numberReady or 0, status.desiredNumberScheduled or 0
+        if ready < desired:
+            self.unit.status = ActiveStatus(f"Pre-pulling images: {ready}/{desired} nodes")
+        else:
+            self.unit.status = ActiveStatus()
 
     def _on_remove(self, _):
         """Event Handler for remove event."""
+        if self.app.planned_units():
+            # Only this unit goes away, the remaining ones keep using the resources
+            log.info("Removing a unit, keeping the resources of the application")
+            return
+        deadline = time.time() + self._teardown_timeout
         manifests = self.resource_handler.render_manifests(force_recompute=False)
+        webhook = MutatingWebhookConfiguration(
+            metadata=ObjectMeta(name=self._mutating_webhook_name)
+        )
         try:
-            delete_many(self.lightkube_client, manifests)
-            self.lightkube_client.delete(MutatingWebhookConfiguration, self._mutating_webhook_name)
+            with self.charm_metrics.timer("remove"):
+                # Applications go first, their CRDs cannot be deleted while they remain
+                removed = self._delete_applications(deadline) and self._delete_all(
+                    [*manifests, webhook], deadline
+                )
         except ApiError as e:
             log.warning(str(e))
+            return
+        if not removed:
+            log.warning(f"Teardown did not finish within {self._teardown_timeout}s, giving up")
 
-    def gen_certs(self):
-        """Generate webhook keys and certs."""
-        model = self.model.name
-        app = self.model.app.name
-        Path("/run/ssl.conf").write_text(
-            f"""[ req ]
-default_bits = 2048
-prompt = no
-default_md = sha256
-req_extensions = req_ext
-distinguished_name = dn
-[ dn ]
-C = GB
-ST = Canonical
-L = Canonical
-O = Canonical
-OU = Canonical
-CN = 127.0.0.1
-[ req_ext ]
-subjectAltName = @alt_names
-[ alt_names ]
-DNS.1 = {app}
-DNS.2 = {app}.{model}
-DNS.3 = {app}.{model}.svc
-DNS.4 = {app}.{model}.svc.cluster
-DNS.5 = {app}.{model}.svc.cluster.local
-IP.1 = 127.0.0.1
-[ v3_ext ]
-authorityKeyIdentifier=keyid,issuer:always
-basicConstraints=CA:FALSE
-keyUsage=keyEncipherment,dataEncipherment,digitalSignature
-extendedKeyUsage=serverAuth,clientAuth
-subjectAltName=@alt_names"""
-        )
+    def _delete_applications(self, deadline: float) -> bool:
+        """Delete the ScheduledSparkApplications, then the SparkApplications, page by page.
 
-        check_call(["openssl", "genrsa", "-out", "/run/ca.key", "2048"])
-        check_call(["openssl", "genrsa", "-out", "/run/server.key", "2048"])
-        check_call(
-            [
-                "openssl",
-                "req",
-                "-x509",
-                "-new",
-                "-sha256",
-                "-nodes",
-                "-days",
-                "3650",
-                "-key",
-                "/run/ca.key",
-                "-subj",
-                "/CN=127.0.0.1",
-                "-out",
-                "/run/ca.crt",
-            ]
-        )
-        check_call(
-            [
-                "openssl",
-                "req",
-                "-new",
-                "-sha256",
-                "-key",
-                "/run/server.key",
-                "-out",
-                "/run/server.csr",
-                "-subj",
-                f"/CN={app}.{model}.svc",
-                "-config",
-                "/run/ssl.conf",
-            ]
-        )
-        check_call(
-            [
-                "openssl",
-                "x509",
-                "-req",
-                "-sha256",
-                "-in",
-                "/run/server.csr",
-                "-CA",
-                "/run/ca.crt",
-                "-CAkey",
-                "/run/ca.key",
-                "-CAcreateserial",
-                "-out",
-                "/run/cert.pem",
-                "-days",
-                "365",
-                "-extensions",
-                "v3_ext",
-                "-extfile",
-                "/run/ssl.conf",
-            ]
-        )
+        Returns:
+            True if all of them were deleted before the deadline.
+        """
+        for resource in (ScheduledSparkApplication, SparkApplication):
+            applications = iter(
+                self.lightkube_client.list(resource, chunk_size=self._teardown_page_size)
+            )
+            deleted = 0
+            while True:
+                try:
+                    page = list(islice(applications, self._teardown_page_size))
+                except ApiError as e:
+                    if e.status.code != 404:
+                        raise
+                    # The CRD is gone already, and its applications with it
+                    log.info(f"No {resource.__name__} CRD, nothing to delete")
+                    break
+                if not page:
+                    break
+                if not self._delete_all(page, deadline):
+                    return False
+                deleted += len(page)
+                self.unit.status = MaintenanceStatus(
+                    f"Removing: deleted {deleted} {resource.__name__}s"
+                )
+                log.info(f"Deleted {deleted} {resource.__name__}s")
+        return True
 
-        return {
-            "cert": Path("/run/cert.pem").read_text(),
-            "key": Path("/run/server.key").read_text(),
-            "ca": Path("/run/ca.crt").read_text(),
-        }
+    def _delete_all(self, objects: list, deadline: float) -> bool:
+        """Delete objects concurrently, giving up on the ones still pending at the deadline.
+
+        Returns:
+            True if all of them were deleted before the deadline.
+        """
+        pool = ThreadPoolExecutor(max_workers=self._teardown_workers)
+        futures = [pool.submit(self._delete_object, obj) for obj in objects]
+        done, pending = wait(futures, timeout=max(deadline - time.time(), 0))
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=False)
+        for future in done:
+            if future.exception() is not None:
+                log.warning(f"Failed to delete during teardown: {future.exception()}")
+        return not pending
+
+    def _delete_object(self, obj) -> None:
+        """Delete the object of a manifest, ignoring it if already gone."""
+        try:
+            self.lightkube_client.delete(
+                type(obj), obj.metadata.name, namespace=obj.metadata.namespace
+            )
+        except ApiError as e:
+            if e.status.code != 404:
+                raise
+
+    def _on_pre_commit(self, _):
+        """Record the charm metrics of this hook and push them to the Pushgateway.
+
+        Prometheus scrapes them from the Pushgateway, nothing else serves them, so they are
+        only published while it is enabled.
+        """
+        self._stored.charm_metrics = self.charm_metrics.merge(self._stored.charm_metrics)
+        if not self.model.config["enable-pushgateway"]:
+            return
+        try:
+            push_group(
+                self._pushgateway_url,
+                {"job": f"{self.model.app.name}-charm", "instance": self.unit.name},
+                self.charm_metrics.render(self._stored.charm_metrics),
+            )
+        except OSError as e:
+            log.warning(f"Failed to push the charm metrics: {e}")
+
+    def gen_certs(self, algorithm: str) -> dict:
+        """Generate webhook keys and certs."""
+        return gen_certs(self.model.app.name, self.model.name, algorithm)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,120 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Timings and counters of the charm's own operations, in Prometheus text format."""
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, List
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRICS_PREFIX = "spark_k8s_charm"
+
+
+class CharmMetrics:
+    """Collects timings and Kubernetes API request counts over the lifetime of a hook.
+
+    Observations are merged into a cumulative state, kept as a JSON string by the
+    charm, so that the rendered histograms and counters grow monotonically across
+    hooks as Prometheus expects.
+    """
+
+    def __init__(self, hook: str, buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.hook = hook
+        self.buckets = sorted(buckets)
+        self._started = time.perf_counter()
+        self._durations: Dict[str, List[float]] = {}
+        self._api_requests = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, operation: str):
+        """Time the wrapped block and record it under `operation`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(operation, time.perf_counter() - start)
+
+    def observe(self, operation: str, seconds: float) -> None:
+        """Record a duration for `operation`."""
+        self._durations.setdefault(operation, []).append(seconds)
+
+    def instrument(self, client) -> None:
+        """Count every request a lightkube Client sends, with an event hook of its httpx client."""
+        client._client._client.event_hooks["request"].append(self._count_request)
+
+    def _count_request(self, _) -> None:
+        # Requests are also sent from the threads of the teardown
+        with self._lock:
+            self._api_requests += 1
+
+    def merge(self, state: str) -> str:
+        """Fold the observations of this hook into a cumulative state.
+
+        Args:
+            state: JSON state as returned by a previous call, or an empty string.
+
+        Returns:
+            The updated JSON state.
+        """
+        data = json.loads(state) if state else {}
+        operations = data.setdefault("operations", {})
+        hooks = data.setdefault("hooks", {})
+        api_requests = data.setdefault("api_requests", {})
+
+        for operation, durations in self._durations.items():
+            for seconds in durations:
+                self._add_observation(operations, operation, seconds)
+        self._add_observation(hooks, self.hook, time.perf_counter() - self._started)
+        api_requests[self.hook] = api_requests.get(self.hook, 0) + self._api_requests
+
+        return json.dumps(data, sort_keys=True)
+
+    def _add_observation(self, histograms: dict, label: str, seconds: float) -> None:
+        histogram = histograms.setdefault(
+            label, {"buckets": [0] * len(self.buckets), "count": 0, "sum": 0.0}
+        )
+        if len(histogram["buckets"]) != len(self.buckets):
+            # Buckets changed since the state was recorded, start the series over
+            histogram.update({"buckets": [0] * len(self.buckets), "count": 0, "sum": 0.0})
+        for index, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                histogram["buckets"][index] += 1
+        histogram["count"] += 1
+        histogram["sum"] += seconds
+
+    def render(self, state: str) -> str:
+        """Render a cumulative state in the Prometheus text exposition format."""
+        data = json.loads(state) if state else {}
+        lines = []
+        lines += self._render_histogram(
+            f"{METRICS_PREFIX}_operation_duration_seconds",
+            "Duration of charm operations such as applying manifests or replanning.",
+            "operation",
+            data.get("operations", {}),
+        )
+        lines += self._render_histogram(
+            f"{METRICS_PREFIX}_hook_duration_seconds",
+            "Duration of charm hooks.",
+            "hook",
+            data.get("hooks", {}),
+        )
+        name = f"{METRICS_PREFIX}_api_requests_total"
+        lines.append(f"# HELP {name} Kubernetes API requests made by the charm.")
+        lines.append(f"# TYPE {name} counter")
+        for hook, count in sorted(data.get("api_requests", {}).items()):
+            lines.append(f'{name}{{hook="{hook}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def _render_histogram(self, name: str, help_text: str, label: str, histograms: dict) -> list:
+        lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        for value, histogram in sorted(histograms.items()):
+            for bound, count in zip(self.buckets, histogram["buckets"]):
+                lines.append(f'{name}_bucket{{{label}="{value}",le="{bound}"}} {count}')
+            lines.append(f'{name}_bucket{{{label}="{value}",le="+Inf"}} {histogram["count"]}')
+            lines.append(f'{name}_sum{{{label}="{value}"}} {histogram["sum"]}')
+            lines.append(f'{name}_count{{{label}="{value}"}} {histogram["count"]}')
+        return lines
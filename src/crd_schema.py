@@ -0,0 +1,91 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Trim the Spark Operator CRD schemas down to what the operator itself needs validated.
+
+The driver and executor specs embed full Kubernetes pod-template types (containers, affinity,
+security contexts, ...). Their expanded schemas make up most of the CRDs, which are sent on every
+apply and kept resident by the API server. This collapses them into subtrees that preserve
+unknown fields, which keeps the schemas structural while the kubelet still validates the pods.
+
+Regenerate src/crds-slim.yaml after changing src/crds.yaml with `tox -e crds`, which runs:
+    python src/crd_schema.py src/crds.yaml src/crds-slim.yaml
+"""
+
+import sys
+
+import yaml
+
+# Fields of SparkPodSpec whose types come from the Kubernetes pod template
+POD_TEMPLATE_FIELDS = (
+    "affinity",
+    "dnsConfig",
+    "env",
+    "envFrom",
+    "hostAliases",
+    "initContainers",
+    "lifecycle",
+    "podSecurityContext",
+    "securityContext",
+    "sidecars",
+    "tolerations",
+    "volumeMounts",
+)
+
+_OPAQUE_OBJECT = {"type": "object", "x-kubernetes-preserve-unknown-fields": True}
+
+# Jinja placeholders are not valid YAML, so they are swapped out while the YAML is processed
+_PLACEHOLDERS = {"{{ app_name }}": "__app_name__"}
+
+
+def _collapse(schema: dict) -> dict:
+    if schema.get("type") == "array":
+        return {"type": "array", "items": dict(_OPAQUE_OBJECT)}
+    return dict(_OPAQUE_OBJECT)
+
+
+def _slim_application_spec(spec: dict) -> None:
+    properties = spec["properties"]
+    for role in ("driver", "executor"):
+        role_properties = properties[role]["properties"]
+        for field in POD_TEMPLATE_FIELDS:
+            if field in role_properties:
+                role_properties[field] = _collapse(role_properties[field])
+    if "volumes" in properties:
+        properties["volumes"] = _collapse(properties["volumes"])
+
+
+def slim_crd(crd: dict) -> dict:
+    """Collapse the pod-template subtrees of a SparkApplication or ScheduledSparkApplication CRD.
+
+    The CRD is modified in place and returned.
+    """
+    for version in crd["spec"]["versions"]:
+        spec = version["schema"]["openAPIV3Schema"]["properties"]["spec"]
+        if crd["spec"]["names"]["kind"] == "ScheduledSparkApplication":
+            spec = spec["properties"]["template"]
+        _slim_application_spec(spec)
+    return crd
+
+
+def slim_crds_template(template: str) -> str:
+    """Return the slimmed version of the CRDs template, selected by the slim_crds context."""
+    for placeholder, value in _PLACEHOLDERS.items():
+        template = template.replace(placeholder, value)
+    lines = [line for line in template.splitlines() if not line.startswith("{%")]
+    crds = [slim_crd(crd) for crd in yaml.safe_load_all("\n".join(lines)) if crd]
+    slimmed = "".join(f"---\n{yaml.safe_dump(crd, sort_keys=False, width=99)}" for crd in crds)
+    for placeholder, value in _PLACEHOLDERS.items():
+        slimmed = slimmed.replace(value, placeholder)
+    return (
+        "# Generated from crds.yaml by crd_schema.py, do not edit\n"
+        f"{{% if slim_crds %}}\n{slimmed}{{% endif %}}\n"
+    )
+
+
+if __name__ == "__main__":
+    source, target = sys.argv[1:]
+    with open(source) as f:
+        template = f.read()
+    with open(target, "w") as f:
+        f.write(slim_crds_template(template))
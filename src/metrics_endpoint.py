@@ -0,0 +1,76 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Metrics endpoint provider that only writes relation data that changed."""
+
+import json
+import socket
+
+from charms.prometheus_k8s.v0.prometheus_scrape import (
+    AlertRules,
+    MetricsEndpointProvider,
+)
+
+
+class MetricsEndpoint(MetricsEndpointProvider):
+    """MetricsEndpointProvider skipping relation data writes of unchanged values.
+
+    Every write fans out a relation-changed event to each related Prometheus unit, and the
+    provider is refreshed on every reconcile. The library is vendored from prometheus-k8s,
+    so the comparison lives here rather than in it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Number of relation data writes performed by the last handled event
+        self.relation_data_writes = 0
+
+    def _set_scrape_job_spec(self, event):
+        """Publish the scrape jobs, metadata, alert rules and unit address, if they changed."""
+        self.relation_data_writes = 0
+        self._update_unit_address()
+
+        if not self._charm.unit.is_leader():
+            return
+
+        alert_rules = AlertRules(topology=self.topology)
+        alert_rules.add_path(self._alert_rules_path, recursive=True)
+        alert_rules_as_dict = alert_rules.as_dict()
+
+        # Sorted, so that equal values serialise identically
+        scrape_metadata = json.dumps(self._scrape_metadata, sort_keys=True)
+        scrape_jobs = json.dumps(self._scrape_jobs, sort_keys=True)
+        alert_rules_json = json.dumps(alert_rules_as_dict, sort_keys=True)
+
+        for relation in self._charm.model.relations[self._relation_name]:
+            databag = relation.data[self._charm.app]
+            self._update_databag(databag, "scrape_metadata", scrape_metadata)
+            self._update_databag(databag, "scrape_jobs", scrape_jobs)
+            if alert_rules_as_dict:
+                self._update_databag(databag, "alert_rules", alert_rules_json)
+
+    def _set_unit_ip(self, _):
+        """Publish the unit address and name, if they changed."""
+        self.relation_data_writes = 0
+        self._update_unit_address()
+
+    def _update_unit_address(self):
+        relations = self._charm.model.relations[self._relation_name]
+        if not relations:
+            return
+
+        # The bind address is a property of the endpoint, so it is resolved once
+        # instead of with a network-get for each relation
+        unit_ip = str(self._charm.model.get_binding(self._relation_name).network.bind_address)
+        unit_address = unit_ip if self._is_valid_unit_address(unit_ip) else socket.getfqdn()
+        unit_name = str(self._charm.model.unit.name)
+
+        for relation in relations:
+            databag = relation.data[self._charm.unit]
+            self._update_databag(databag, "prometheus_scrape_unit_address", unit_address)
+            self._update_databag(databag, "prometheus_scrape_unit_name", unit_name)
+
+    def _update_databag(self, databag, key: str, value: str) -> None:
+        if databag.get(key) != value:
+            databag[key] = value
+            self.relation_data_writes += 1
@@ -0,0 +1,81 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Helpers for the Prometheus Pushgateway companion service."""
+
+import base64
+import json
+import logging
+import time
+from typing import Optional
+from urllib.request import Request, urlopen
+
+log = logging.getLogger(__name__)
+
+
+def _group_path(labels: dict) -> str:
+    """Build the grouping key path of a group, base64 encoding every value.
+
+    Encoding every value keeps label values containing `/` addressable.
+    """
+    labels = dict(labels)
+    path = f"/metrics/job@base64/{_encode(labels.pop('job'))}"
+    for name, value in sorted(labels.items()):
+        path += f"/{name}@base64/{_encode(value)}"
+    return path
+
+
+def _encode(value: str) -> str:
+    # The Pushgateway represents an empty value as a single `=`
+    return base64.urlsafe_b64encode(value.encode()).decode() or "="
+
+
+def evict_stale_groups(
+    url: str, ttl: int, now: Optional[float] = None, timeout: float = 10.0
+) -> int:
+    """Delete metric groups that have not been pushed to for longer than `ttl` seconds.
+
+    The Pushgateway never expires groups on its own, so the metrics of finished
+    SparkApplications would otherwise accumulate for as long as it runs.
+
+    Args:
+        url: base URL of the Pushgateway, e.g. `http://localhost:9091`.
+        ttl: maximum age, in seconds, of the last push to a group.
+        now: current time as a UNIX timestamp, defaults to `time.time()`.
+        timeout: timeout in seconds for each request.
+
+    Returns:
+        The number of groups deleted.
+    """
+    now = time.time() if now is None else now
+    with urlopen(f"{url}/api/v1/metrics", timeout=timeout) as response:
+        groups = json.load(response).get("data", [])
+
+    evicted = 0
+    for group in groups:
+        pushed = group.get("push_time_seconds", {}).get("metrics", [])
+        if not pushed or "job" not in group.get("labels", {}):
+            continue
+        if now - float(pushed[0]["value"]) <= ttl:
+            continue
+        request = Request(f"{url}{_group_path(group['labels'])}", method="DELETE")
+        with urlopen(request, timeout=timeout):
+            evicted += 1
+    if evicted:
+        log.info(f"Evicted {evicted} stale Pushgateway groups")
+    return evicted
+
+
+def push_group(url: str, labels: dict, metrics: str, timeout: float = 2.0) -> None:
+    """Replace the metrics of a group with `metrics`, in Prometheus text format.
+
+    Args:
+        url: base URL of the Pushgateway, e.g. `http://localhost:9091`.
+        labels: grouping key of the group, including `job`.
+        metrics: the metrics, in Prometheus text format.
+        timeout: timeout in seconds of the request.
+    """
+    request = Request(f"{url}{_group_path(labels)}", data=metrics.encode(), method="PUT")
+    request.add_header("Content-Type", "text/plain; version=0.0.4")
+    with urlopen(request, timeout=timeout):
+        pass
@@ -0,0 +1,53 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Lightkube resources and helpers for the Spark Operator custom resources."""
+
+import copy
+from datetime import datetime, timezone
+from typing import Optional
+
+from lightkube.generic_resource import create_namespaced_resource
+
+SparkApplication = create_namespaced_resource(
+    group="sparkoperator.k8s.io",
+    version="v1beta2",
+    kind="SparkApplication",
+    plural="sparkapplications",
+)
+
+ScheduledSparkApplication = create_namespaced_resource(
+    group="sparkoperator.k8s.io",
+    version="v1beta2",
+    kind="ScheduledSparkApplication",
+    plural="scheduledsparkapplications",
+)
+
+TERMINAL_STATES = ("COMPLETED", "FAILED")
+
+
+def parse_time(value: Optional[str]) -> Optional[float]:
+    """Convert a Kubernetes RFC 3339 timestamp into a UNIX timestamp."""
+    if not value:
+        return None
+    parsed = datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ")
+    return parsed.replace(tzinfo=timezone.utc).timestamp()
+
+
+def application_state(app) -> str:
+    """Return the state of a SparkApplication, e.g. RUNNING, or an empty string."""
+    status = app.status or {}
+    return status.get("applicationState", {}).get("state", "")
+
+
+def with_profile(manifest: dict, profile: dict) -> dict:
+    """Return a copy of a SparkApplication manifest with a performance profile applied.
+
+    The profile is merged into spec.sparkConf, which the operator passes to spark-submit as
+    --conf, so that it also covers settings read at submission. Properties the application
+    sets itself take precedence.
+    """
+    manifest = copy.deepcopy(manifest)
+    spec = manifest.setdefault("spec", {})
+    spec["sparkConf"] = {**profile, **(spec.get("sparkConf") or {})}
+    return manifest
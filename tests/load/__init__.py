@@ -0,0 +1,6 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import ops.testing
+
+ops.testing.SIMULATE_CAN_CONNECT = True
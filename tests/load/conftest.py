@@ -0,0 +1,113 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import json
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+from urllib.request import Request, urlopen
+
+import pytest
+from lightkube import Client, KubeConfig
+from ops.testing import Harness
+
+from charm import KubernetesServicePatch, SparkCharm
+
+from . import fake_apiserver
+
+# Number of SparkApplications the load tests work with
+APPLICATIONS = int(os.environ.get("LOAD_TEST_APPLICATIONS", 2000))
+
+
+class ApiServer:
+    """Client of the control endpoints of a fake API server."""
+
+    def __init__(self, url: str):
+        self.url = url
+
+    def _call(self, path: str, body: dict = None) -> dict:
+        data = None if body is None else json.dumps(body).encode()
+        request = Request(f"{self.url}{path}", data=data, method="GET" if data is None else "POST")
+        with urlopen(request) as response:
+            return json.loads(response.read())
+
+    def stats(self) -> dict:
+        return self._call("/_stats")
+
+    def reset(self) -> None:
+        self._call("/_reset", {})
+
+    def seed(self, path: str, objects: list) -> None:
+        self._call("/_seed", {"items": [{**obj, "path": path} for obj in objects]})
+
+    @property
+    def config(self) -> KubeConfig:
+        # Like the in-cluster config of the charm, which defaults to the namespace of the model
+        context = {"cluster": "fake", "user": "fake", "namespace": "kubeflow"}
+        return KubeConfig.from_dict(
+            {
+                "clusters": [{"name": "fake", "cluster": {"server": self.url}}],
+                "users": [{"name": "fake", "user": {}}],
+                "contexts": [{"name": "fake", "context": context}],
+                "current-context": "fake",
+            }
+        )
+
+    def client(self, **kwargs) -> Client:
+        return Client(self.config, trust_env=False, **kwargs)
+
+
+@pytest.fixture()
+def apiserver():
+    process, url = fake_apiserver.start()
+    yield ApiServer(url)
+    process.terminate()
+
+
+@pytest.fixture()
+def harness(apiserver, mocker):
+    mocker.patch("charm.Client", apiserver.client)
+    mocker.patch(
+        "charmed_kubeflow_chisme.kubernetes._kubernetes_resource_handler.Client",
+        apiserver.client,
+    )
+    mocker.patch(
+        "charm.SparkCharm.gen_certs",
+        return_value={"cert": "fake-cert", "key": "fake-server-key", "ca": "fake-ca-cert"},
+    )
+    mocker.patch.object(KubernetesServicePatch, "_namespace", lambda x, y: "")
+    mocker.patch.object(KubernetesServicePatch, "_patch", lambda x, y: None)
+    harness = Harness(SparkCharm)
+    harness.set_model_name("kubeflow")
+    harness.set_leader(True)
+    apiserver.reset()
+    yield harness
+    harness.cleanup()
+
+
+@pytest.fixture()
+def measure(request):
+    """Measure the wall time and peak memory of a block and print them with the API requests."""
+
+    @contextmanager
+    def _measure(apiserver: ApiServer):
+        apiserver.reset()
+        tracemalloc.start()
+        start = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        stats = apiserver.stats()
+        requests = stats["requests"]
+        print(
+            f"\n{request.node.name}: {elapsed:.2f}s, peak {peak / 2**20:.1f} MiB, "
+            f"{sum(stats['received'].values()) / 2**10:.0f} KiB sent, "
+            f"{sum(requests.values())} requests {json.dumps(requests, sort_keys=True)}"
+        )
+        _measure.requests = requests
+        _measure.received = stats["received"]
+        _measure.elapsed = elapsed
+
+    return _measure
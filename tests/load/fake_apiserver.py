@@ -0,0 +1,271 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""In-memory stand-in for the Kubernetes API server, for load tests.
+
+It stores objects of any kind by their REST path and understands the subset of the API used by
+lightkube: get, list (with label selectors and pagination), create, server-side apply and delete.
+SparkApplications created through the API move through SUBMITTED, RUNNING and COMPLETED as
+they age, the way the Spark Operator would move them.
+
+Requests and the bytes they send are counted per verb and resource. The control endpoints,
+which are not counted, are:
+    GET /_stats     the request and byte counts and the number of stored objects per resource
+    POST /_reset    reset the request and byte counts
+    POST /_seed     store a list of objects directly, e.g. thousands of SparkApplications
+"""
+
+import json
+import multiprocessing
+import re
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock
+from urllib.parse import parse_qs, urlparse
+
+_SELECTOR = re.compile(r"([^,(]+(?:\([^)]*\))?)")
+
+
+def _timestamp(value: float) -> str:
+    return datetime.fromtimestamp(value, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _matches(labels: dict, selector: str) -> bool:
+    """Whether `labels` match a label selector as built by lightkube."""
+    for requirement in _SELECTOR.findall(selector or ""):
+        requirement = requirement.strip(" ,")
+        if " notin " in requirement or " in " in requirement:
+            key, operator, values = re.match(r"(\S+) (notin|in) \((.*)\)", requirement).groups()
+            if (labels.get(key) in values.split(",")) != (operator == "in"):
+                return False
+        elif "!=" in requirement:
+            key, value = requirement.split("!=", 1)
+            if labels.get(key) == value:
+                return False
+        elif "=" in requirement:
+            key, value = requirement.split("=", 1)
+            if labels.get(key) != value:
+                return False
+        elif requirement.startswith("!"):
+            if requirement[1:] in labels:
+                return False
+        elif requirement not in labels:
+            return False
+    return True
+
+
+class FakeApiServer:
+    """Objects keyed by (api prefix, namespace, plural), then by name."""
+
+    def __init__(self, submit_delay: float, run_delay: float, complete_delay: float):
+        self.delays = {
+            "SUBMITTED": submit_delay,
+            "RUNNING": run_delay,
+            "COMPLETED": complete_delay,
+        }
+        self.objects = {}
+        self.created = {}
+        self.requests = Counter()
+        self.received = Counter()
+        self.lock = Lock()
+
+    def _simulate(self, key: tuple, obj: dict) -> dict:
+        """Fill in the status of a SparkApplication created through the API."""
+        created = self.created.get((*key, obj["metadata"]["name"]))
+        if created is None or obj.get("kind") != "SparkApplication":
+            return obj
+        status = {}
+        age = time.time() - created
+        for state, delay in self.delays.items():
+            if age >= delay:
+                status["applicationState"] = {"state": state}
+        if age >= self.delays["SUBMITTED"]:
+            status["lastSubmissionAttemptTime"] = _timestamp(created + self.delays["SUBMITTED"])
+        if age >= self.delays["COMPLETED"]:
+            status["terminationTime"] = _timestamp(created + self.delays["COMPLETED"])
+        return {**obj, "status": status} if status else obj
+
+    def store(self, key: tuple, obj: dict, simulate: bool = False) -> dict:
+        metadata = obj.setdefault("metadata", {})
+        name = metadata["name"]
+        with self.lock:
+            previous = self.objects.setdefault(key, {}).get(name)
+            if previous is None:
+                metadata.setdefault("uid", f"uid-{len(self.created)}-{name}")
+                metadata.setdefault("creationTimestamp", _timestamp(time.time()))
+                if simulate:
+                    self.created[(*key, name)] = time.time()
+            else:
+                metadata["uid"] = previous["metadata"]["uid"]
+                metadata["creationTimestamp"] = previous["metadata"]["creationTimestamp"]
+                if "status" in previous:
+                    obj.setdefault("status", previous["status"])
+            self.objects[key][name] = obj
+        return obj
+
+    def get(self, key: tuple, name: str):
+        obj = self.objects.get(key, {}).get(name)
+        return None if obj is None else self._simulate(key, obj)
+
+    def list(self, key: tuple, selector: str, limit: int, after: str):
+        """Return a page of matching objects, in name order, and the token of the next page."""
+        with self.lock:
+            items = [
+                obj
+                for name, obj in sorted(self.objects.get(key, {}).items())
+                if name > after and _matches(obj["metadata"].get("labels") or {}, selector)
+            ]
+        page = items[:limit] if limit else items
+        next_page = page[-1]["metadata"]["name"] if len(page) < len(items) else None
+        return [self._simulate(key, obj) for obj in page], next_page
+
+    def delete(self, key: tuple, name: str):
+        with self.lock:
+            self.created.pop((*key, name), None)
+            return self.objects.get(key, {}).pop(name, None)
+
+
+def _parse_path(path: str):
+    """Split a REST path into ((api prefix, namespace, plural), name)."""
+    parts = path.strip("/").split("/")
+    prefix_length = 2 if parts[0] == "api" else 3
+    prefix, rest = "/".join(parts[:prefix_length]), parts[prefix_length:]
+    namespace = None
+    if rest[0] == "namespaces" and len(rest) >= 3:
+        namespace, rest = rest[1], rest[2:]
+    return (prefix, namespace, rest[0]), (rest[1] if len(rest) > 1 else None)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = "fake-apiserver"
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, which Nagle's algorithm would delay by ~40ms
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def api(self) -> FakeApiServer:
+        return self.server.api
+
+    def _reply(self, code: int, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _not_found(self, name: str):
+        self._reply(
+            404,
+            {
+                "apiVersion": "v1",
+                "kind": "Status",
+                "status": "Failure",
+                "reason": "NotFound",
+                "message": f"{name} not found",
+                "code": 404,
+            },
+        )
+
+    def _body(self) -> dict:
+        return json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+
+    def _handle(self, verb: str):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if url.path.startswith("/_"):
+            return self._control(url.path)
+        time.sleep(self.server.latency)
+        key, name = _parse_path(url.path)
+        if verb == "GET" and name is None:
+            verb = "LIST"
+        with self.api.lock:
+            self.api.requests[f"{verb} {key[2]}"] += 1
+            self.api.received[f"{verb} {key[2]}"] += int(self.headers.get("Content-Length", 0))
+
+        if verb == "LIST":
+            items, next_page = self.api.list(
+                key,
+                query.get("labelSelector"),
+                int(query.get("limit", 0)),
+                query.get("continue", ""),
+            )
+            metadata = {"continue": next_page}
+            return self._reply(200, {"kind": "List", "metadata": metadata, "items": items})
+        if verb == "GET":
+            obj = self.api.get(key, name)
+            return self._reply(200, obj) if obj else self._not_found(name)
+        if verb == "POST":
+            return self._reply(201, self.api.store(key, self._body(), simulate=True))
+        if verb == "PATCH":
+            body = self._body()
+            body.setdefault("metadata", {})["name"] = name
+            return self._reply(200, self.api.store(key, body, simulate=True))
+        if verb == "DELETE":
+            obj = self.api.delete(key, name)
+            return self._reply(200, obj) if obj else self._not_found(name)
+
+    def _control(self, path: str):
+        if path == "/_stats":
+            objects = Counter()
+            for (_, namespace, plural), objs in self.api.objects.items():
+                objects[f"{plural} in {namespace}" if namespace else plural] += len(objs)
+            return self._reply(
+                200,
+                {
+                    "requests": self.api.requests,
+                    "received": +self.api.received,
+                    "objects": +objects,
+                },
+            )
+        if path == "/_reset":
+            self.api.requests.clear()
+            self.api.received.clear()
+            return self._reply(200, {})
+        if path == "/_seed":
+            for item in self._body()["items"]:
+                self.api.store(_parse_path(item.pop("path"))[0], item)
+            return self._reply(200, {})
+
+    def do_GET(self):  # noqa: N802
+        self._handle("GET")
+
+    def do_POST(self):  # noqa: N802
+        self._handle("POST")
+
+    def do_PATCH(self):  # noqa: N802
+        self._handle("PATCH")
+
+    def do_DELETE(self):  # noqa: N802
+        self._handle("DELETE")
+
+
+def _serve(ready, latency: float, delays: tuple):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    server.daemon_threads = True
+    server.api = FakeApiServer(*delays)
+    server.latency = latency
+    ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start(latency: float = 0.0, delays: tuple = (0.5, 1.0, 2.0)):
+    """Run the server in a child process, so it does not skew the memory measured by the tests.
+
+    Args:
+        latency: seconds added to every API request, to simulate a remote API server
+        delays: seconds after creation at which a SparkApplication is SUBMITTED, RUNNING and
+            COMPLETED
+
+    Returns:
+        The child process and the URL of the server.
+    """
+    ready = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve, args=(ready, latency, delays), daemon=True)
+    process.start()
+    return process, f"http://127.0.0.1:{ready.get(timeout=10)}"
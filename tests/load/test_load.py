@@ -0,0 +1,106 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import math
+from pathlib import Path
+
+import yaml
+from charmed_kubeflow_chisme.kubernetes import KubernetesResourceHandler as KRH
+
+from benchmark import SubmissionBenchmark
+from spark_application import SparkApplication
+
+from .conftest import APPLICATIONS
+
+SPARK_APPLICATIONS = "/apis/sparkoperator.k8s.io/v1beta2/namespaces/kubeflow/sparkapplications"
+
+
+def finished_application(index: int) -> dict:
+    return {
+        "apiVersion": "sparkoperator.k8s.io/v1beta2",
+        "kind": "SparkApplication",
+        "metadata": {"name": f"spark-pi-{index:05}", "namespace": "kubeflow"},
+        "spec": {"type": "Scala", "mode": "cluster"},
+        "status": {
+            "applicationState": {"state": "COMPLETED"},
+            "lastSubmissionAttemptTime": "2022-08-16T09:59:00Z",
+            "terminationTime": "2022-08-16T10:00:00Z",
+        },
+    }
+
+
+def test_apply_and_remove(harness, apiserver, measure):
+    apiserver.seed(SPARK_APPLICATIONS, [finished_application(i) for i in range(APPLICATIONS)])
+    harness.begin()
+    manifests = harness.charm.resource_handler.render_manifests()
+
+    with measure(apiserver):
+        assert harness.charm._apply_resources()
+    assert measure.requests["PATCH customresourcedefinitions"] == 2
+    # The charm counts the requests its clients actually sent
+    assert harness.charm.charm_metrics._api_requests == sum(measure.requests.values())
+
+    harness.set_planned_units(0)
+    with measure(apiserver):
+        harness.charm._on_remove(None)
+    assert measure.requests["LIST sparkapplications"] == math.ceil(APPLICATIONS / 500)
+    deletes = sum(count for request, count in measure.requests.items() if "DELETE" in request)
+    assert deletes == APPLICATIONS + len(manifests) + 1
+    assert apiserver.stats()["objects"] == {}
+
+
+def test_prune_applications(harness, apiserver, measure):
+    apiserver.seed(SPARK_APPLICATIONS, [finished_application(i) for i in range(APPLICATIONS)])
+    harness.update_config({"application-ttl": 3600})
+    harness.add_storage("archive")
+    harness.begin()
+    Path(harness.charm.model.storages["archive"][0].location).mkdir(parents=True)
+    batch = harness.charm._prune_batch_size
+
+    with measure(apiserver):
+        harness.charm._prune_applications()
+    assert measure.requests["LIST sparkapplications"] == 1
+    assert measure.requests["DELETE sparkapplications"] == batch
+
+    hooks = math.ceil(APPLICATIONS / batch)
+    with measure(apiserver):
+        for _ in range(hooks - 1):
+            harness.charm._prune_applications()
+    assert apiserver.stats()["objects"] == {}
+    assert len(harness.charm._archive.query(limit=APPLICATIONS)) == APPLICATIONS
+
+
+def test_submission_benchmark(apiserver, measure):
+    manifest = yaml.safe_load(Path("examples/spark-pi.yaml").read_text())
+    client = apiserver.client(namespace="kubeflow")
+    benchmark = SubmissionBenchmark(client, manifest, "kubeflow")
+
+    with measure(apiserver):
+        results = benchmark.run(count=APPLICATIONS, concurrency=50, timeout=120, poll_interval=0.5)
+    assert measure.requests["POST sparkapplications"] == APPLICATIONS
+    assert results["completed"] == APPLICATIONS
+    assert results["submitted"]["p99"] <= 2
+
+    benchmark.cleanup()
+    assert not list(client.list(SparkApplication, namespace="kubeflow"))
+
+
+def test_slim_crd_schemas(harness, apiserver, measure):
+    harness.begin()
+    crds = {}
+    for slim_crds in (False, True):
+        resource_handler = KRH(
+            template_files=["src/crds.yaml", "src/crds-slim.yaml"],
+            context={**harness.charm._context, "slim_crds": slim_crds},
+            field_manager="spark-k8s",
+            lightkube_client=apiserver.client(field_manager="spark-k8s"),
+        )
+        with measure(apiserver):
+            resource_handler.apply()
+        crds[slim_crds] = (measure.received["PATCH customresourcedefinitions"], measure.elapsed)
+
+    print(
+        f"\nCRDs apply: full {crds[False][0] / 2**10:.0f} KiB in {crds[False][1] * 1000:.0f}ms, "
+        f"slim {crds[True][0] / 2**10:.0f} KiB in {crds[True][1] * 1000:.0f}ms"
+    )
+    assert crds[True][0] < crds[False][0] / 4
@@ -0,0 +1,50 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+import socket
+import ssl
+import threading
+import time
+
+from certs import KEY_ALGORITHMS, gen_certs
+
+HANDSHAKES = 200
+
+
+def server_handshake_cost(certs: dict, tmp_path) -> float:
+    """Mean CPU seconds the webhook side spends per TLS handshake with a fresh connection."""
+    (tmp_path / "cert.pem").write_text(certs["cert"])
+    (tmp_path / "key.pem").write_text(certs["key"])
+    server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server_context.load_cert_chain(tmp_path / "cert.pem", tmp_path / "key.pem")
+    client_context = ssl.create_default_context(cadata=certs["ca"])
+    listener = socket.create_server(("127.0.0.1", 0))
+    cpu = []
+
+    def serve():
+        for _ in range(HANDSHAKES):
+            connection, _ = listener.accept()
+            start = time.thread_time()
+            with server_context.wrap_socket(connection, server_side=True):
+                cpu.append(time.thread_time() - start)
+
+    server = threading.Thread(target=serve)
+    server.start()
+    for _ in range(HANDSHAKES):
+        with socket.create_connection(listener.getsockname()) as connection:
+            client_context.wrap_socket(connection, server_hostname="spark-k8s.kubeflow.svc")
+    server.join()
+    listener.close()
+    return sum(cpu) / len(cpu)
+
+
+def test_webhook_handshake_cost(tmp_path):
+    costs = {
+        algorithm: server_handshake_cost(gen_certs("spark-k8s", "kubeflow", algorithm), tmp_path)
+        for algorithm in KEY_ALGORITHMS
+    }
+
+    print(
+        "\nWebhook CPU per TLS handshake: "
+        + ", ".join(f"{algorithm} {cost * 1000:.3f}ms" for algorithm, cost in costs.items())
+    )
+    assert costs["ecdsa-p256"] < costs["rsa-2048"]
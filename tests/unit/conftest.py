@@ -7,6 +7,7 @@ import pytest
 from ops.testing import Harness
 
 from charm import KubernetesServicePatch, SparkCharm
+from spark_application import SparkApplication
 
 
 @pytest.fixture
@@ -16,6 +17,11 @@ def harness():
     return harness
 
 
+@pytest.fixture(autouse=True)
+def mocked_operator_ready(mocker):
+    yield mocker.patch("charm.SparkCharm._operator_ready", return_value=True)
+
+
 @pytest.fixture()
 def mocked_lightkube_client(mocker):
     mocked_client = mocker.patch("charm.Client")
@@ -38,6 +44,7 @@ def mocked_cert(mocker):
 def mocked_kubernetes_service_patcher(mocker):
     mocker.patch.object(KubernetesServicePatch, "_namespace", lambda x, y: "")
     mocker.patch.object(KubernetesServicePatch, "_patch", lambda x, y: None)
+    mocker.patch.object(KubernetesServicePatch, "is_patched", lambda x: True)
 
     yield
 
@@ -47,3 +54,27 @@ def mocked_resource_handler(mocker):
     mocked_resource_handler = mocker.patch("charm.KRH")
     mocked_resource_handler.return_value = MagicMock()
     yield mocked_resource_handler
+
+
+@pytest.fixture()
+def spark_application():
+    """Factory of SparkApplications as the operator reports them once they ran."""
+
+    def make(name, state="COMPLETED", terminated="2022-08-16T10:00:00Z"):
+        return SparkApplication(
+            metadata={"name": name, "namespace": "kubeflow", "uid": f"uid-{name}"},
+            spec={"type": "Scala", "mode": "cluster"},
+            status={
+                "applicationState": {"state": state},
+                "lastSubmissionAttemptTime": "2022-08-16T09:59:00Z",
+                "terminationTime": terminated,
+                "submissionAttempts": 1,
+                "executionAttempts": 1,
+                "executorState": {
+                    "spark-pi-exec-1": "COMPLETED",
+                    "spark-pi-exec-2": "FAILED",
+                },
+            },
+        )
+
+    return make
@@ -0,0 +1,27 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+from archive import ApplicationArchive, application_record
+from spark_application import parse_time
+
+
+def test_application_record(spark_application):
+    record = application_record(spark_application("spark-pi"))
+
+    assert record["state"] == "COMPLETED"
+    assert record["termination_time"] - record["submission_time"] == 60
+    assert record["executors"] == 2
+    assert record["failed_executors"] == 1
+    assert application_record(spark_application("spark-pi", state="RUNNING")) is None
+
+
+def test_archive_query(tmp_path, spark_application):
+    archive = ApplicationArchive(tmp_path / "applications.db")
+    archive.add(application_record(spark_application("a", terminated="2022-08-16T10:00:00Z")))
+    archive.add(application_record(spark_application("b", terminated="2022-08-16T11:00:00Z")))
+    archive.add(application_record(spark_application("c", terminated="2022-08-16T12:00:00Z")))
+
+    assert [r["name"] for r in archive.query()] == ["c", "b", "a"]
+    assert [r["name"] for r in archive.query(name="b")] == ["b"]
+    until = parse_time("2022-08-16T11:00:00Z")
+    assert [r["name"] for r in archive.query(until=until)] == ["b", "a"]
+    assert len(archive.query(limit=1)) == 1
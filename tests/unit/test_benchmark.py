@@ -0,0 +1,46 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+from unittest.mock import MagicMock
+
+from benchmark import BENCHMARK_LABEL, SubmissionBenchmark, percentiles
+from spark_application import SparkApplication
+
+
+def test_percentiles():
+    assert percentiles([]) == {}
+    assert percentiles(range(1, 101)) == {"p50": 50, "p95": 95, "p99": 99}
+    assert percentiles([3.0]) == {"p50": 3.0, "p95": 3.0, "p99": 3.0}
+
+
+def test_submission_benchmark(mocker):
+    mocker.patch("benchmark.time.time", return_value=1660643940.0)  # 2022-08-16T09:59:00Z
+    mocker.patch("benchmark.time.sleep")
+    client = MagicMock()
+    benchmark = SubmissionBenchmark(client, {"metadata": {"name": "spark-pi"}}, "kubeflow")
+
+    def finished(app, namespace):
+        finished.apps.append(
+            SparkApplication(
+                metadata=app.metadata,
+                status={
+                    "applicationState": {"state": "COMPLETED"},
+                    "lastSubmissionAttemptTime": "2022-08-16T09:59:02Z",
+                    "terminationTime": "2022-08-16T10:00:00Z",
+                },
+            )
+        )
+
+    finished.apps = []
+    client.create.side_effect = finished
+    client.list.side_effect = lambda *args, **kwargs: finished.apps
+
+    results = benchmark.run(count=4, concurrency=2, timeout=60)
+
+    assert client.create.call_count == 4
+    created = client.create.call_args.args[0]
+    assert created.metadata.labels == {BENCHMARK_LABEL: benchmark.run_id}
+    assert created.metadata.name.startswith(f"spark-pi-bench-{benchmark.run_id}-")
+    assert results["submitted"] == {"p50": 2.0, "p95": 2.0, "p99": 2.0}
+    assert results["end-to-end"]["p99"] == 60.0
+    assert results["completed"] == 4
+    assert results["timed-out"] == 0
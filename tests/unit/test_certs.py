@@ -0,0 +1,39 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+import ssl
+
+import pytest
+
+from certs import KEY_ALGORITHMS, gen_certs
+
+
+def handshake(certs: dict, hostname: str, tmp_path) -> str:
+    """Complete a TLS handshake in memory, returning the cipher the server negotiated."""
+    (tmp_path / "cert.pem").write_text(certs["cert"])
+    (tmp_path / "key.pem").write_text(certs["key"])
+    server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server_context.load_cert_chain(tmp_path / "cert.pem", tmp_path / "key.pem")
+    client_context = ssl.create_default_context(cadata=certs["ca"])
+
+    server_in, server_out, client_in, client_out = (ssl.MemoryBIO() for _ in range(4))
+    server = server_context.wrap_bio(server_in, server_out, server_side=True)
+    client = client_context.wrap_bio(client_in, client_out, server_hostname=hostname)
+    pending = {client, server}
+    while pending:
+        for side in list(pending):
+            try:
+                side.do_handshake()
+                pending.discard(side)
+            except ssl.SSLWantReadError:
+                pass
+        server_in.write(client_out.read())
+        client_in.write(server_out.read())
+    return server.cipher()[0]
+
+
+@pytest.mark.parametrize("algorithm", KEY_ALGORITHMS)
+def test_gen_certs(algorithm, tmp_path):
+    certs = gen_certs("spark-k8s", "kubeflow", algorithm)
+
+    assert ("EC PRIVATE KEY" in certs["key"]) == (algorithm == "ecdsa-p256")
+    assert handshake(certs, "spark-k8s.kubeflow.svc", tmp_path)
@@ -1,6 +1,36 @@
 # Copyright 2022 Canonical Ltd.
 # See LICENSE file for licensing details.
-from ops.model import ActiveStatus, WaitingStatus
+import base64
+import json
+import time
+from pathlib import Path
+from unittest.mock import MagicMock
+
+import yaml
+from charmed_kubeflow_chisme.kubernetes import KubernetesResourceHandler as KRH
+from lightkube.core.exceptions import ApiError
+from lightkube.models.core_v1 import PodStatus
+from lightkube.models.meta_v1 import ObjectMeta, Status
+from lightkube.resources.admissionregistration_v1 import MutatingWebhookConfiguration
+from lightkube.resources.apiextensions_v1 import CustomResourceDefinition
+from lightkube.resources.apps_v1 import DaemonSet
+from lightkube.resources.core_v1 import ConfigMap, Pod
+from lightkube.resources.scheduling_v1 import PriorityClass
+from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus, WaitingStatus
+from ops.testing import Harness
+
+from charm import SparkCharm
+from spark_application import SparkApplication
+
+
+def webhook(object_selector=None):
+    return {
+        "name": "webhook.sparkoperator.k8s.io",
+        "admissionReviewVersions": ["v1"],
+        "clientConfig": {"service": {"name": "spark-k8s", "namespace": "kubeflow"}},
+        "sideEffects": "None",
+        "objectSelector": object_selector,
+    }
 
 
 def test_pebble_ready_event(
@@ -45,6 +75,8 @@ def test_config_changed_cannot_connect(
     harness.charm.on.config_changed.emit()
 
     assert isinstance(harness.charm.unit.status, WaitingStatus)
+    # Picked up on spark-pebble-ready instead
+    assert not list(harness.framework._storage.notices())
 
 
 def test_config_changed_metrics_port(
@@ -65,3 +97,1022 @@ def test_config_changed_metrics_port(
     plan_2 = harness.get_container_pebble_plan("spark").to_dict()["services"]
 
     assert "-metrics-port=1234" in plan_2["spark"]["command"]
+
+
+def test_metrics_endpoint_skips_unchanged_relation_data(
+    harness,
+    mocker,
+    mocked_lightkube_client,
+    mocked_cert,
+    mocked_kubernetes_service_patcher,
+    mocked_resource_handler,
+):
+    network_get = mocker.patch.object(
+        harness._backend,
+        "network_get",
+        create=True,
+        return_value={"bind-addresses": [{"addresses": [{"value": "10.1.2.3"}]}]},
+    )
+    harness.begin()
+    harness.add_relation("metrics-endpoint", "prometheus-k8s")
+    harness.add_relation("metrics-endpoint", "prometheus-k8s-2")
+
+    provider = harness.charm.metrics_endpoint
+    provider._set_scrape_job_spec(None)
+    # scrape_metadata, scrape_jobs, unit address and unit name for each relation
+    assert provider.relation_data_writes == 8
+    # The bind address is resolved per endpoint, not per relation
+    network_get.assert_called_once()
+
+    harness.charm.on.upgrade_charm.emit()
+    assert provider.relation_data_writes == 0
+
+
+def test_application_metrics_defaults(
+    harness,
+    mocked_lightkube_client,
+    mocked_cert,
+    mocked_kubernetes_service_patcher,
+    mocked_resource_handler,
+):
+    harness.begin()
+    harness.container_pebble_ready("spark")
+
+    spark_defaults = harness.charm.container.pull("/opt/spark/conf/spark-defaults.conf").read()
+    assert "spark.ui.prometheus.enabled true" in spark_defaults
+
+    # Released Prometheus charms drop pod discovery from related jobs, drivers are annotated
+    assert len(harness.charm._scrape_jobs) == 1
+    driver = yaml.safe_load(
+        harness.charm.container.pull("/etc/spark-k8s/pod-templates/default/default/driver.yaml")
+    )
+    assert driver["metadata"]["annotations"] == {
+        "prometheus.io/scrape": "true",
+        "prometheus.io/port": "4040",
+        "prometheus.io/path": "/metrics/prometheus/",
+    }
+
+    harness.update_config({"enable-application-metrics": False})
+    spark_defaults = harness.charm.container.pull("/opt/spark/conf/spark-defaults.conf").read()
+    assert "prometheus" not in spark_defaults
+    driver = yaml.safe_load(
+        harness.charm.container.pull("/etc/spark-k8s/pod-templates/default/default/driver.yaml")
+    )
+    assert "annotations" not in driver["metadata"]
+
+
+def test_charm_metrics_pushed_on_commit(
+    harness,
+    mocker,
+    mocked_lightkube_client,
+    mocked_cert,
+    mocked_kubernetes_service_patcher,
+    mocked_resource_handler,
+):
+    push_group = mocker.patch("charm.push_group")
+    harness.begin()
+    harness.container_pebble_ready("spark")
+    harness.framework.commit()
+    push_group.assert_not_called()
+
+    harness.update_config({"enable-pushgateway": True})
+    harness.framework.commit()
+    url, labels, pushed = push_group.call_args.args
+    assert url == "http://spark-k8s-pushgateway.None.svc:9091"
+    assert labels == {"job": "spark-k8s-charm", "instance": "spark-k8s/0"}
+    assert 'operation="update_layer"' in pushed
+
+
+def test_config_changed_metrics_labels_and_buckets(
+    harness,
+    mocked_lightkube_client,
+    mocked_cert,
+    mocked_kubernetes_service_patcher,
+    mocked_resource_handler,
+):
+    harness.begin()
+    harness.container_pebble_ready("spark")
+
+    harness.update_config(
+        {"metrics-labels": "app_type, team", "metrics-job-start-latency-buckets": "5,10,30"}
+    )
+    command = harness.get_container_pebble_plan("spark").to_dict()["services"]["spark"]["command"]
+    assert "-metrics-labels=app_type -metrics-labels=team " in command
+    assert "-metrics-job-start-latency-buckets=5.0,10.0,30.0 " in command
+
+    harness.update_config({"metrics-job-start-latency-buckets": "30,10"})
+    assert isinstance(harness.charm.unit.status, BlockedStatus)
+
+
+def test_pushgateway_enabled(
+    harness,
+    mocked_lightkube_client,
+    mocked_cert,
+    mocked_kubernetes_service_patcher,
+    mocked_resource_handler,
+):
+    harness.set_model_name("kubeflow")
+    harness.update_config({"enable-pushgateway": True})
+    harness.begin()
+    harness.container_pebble_ready("spark")
+
+    manifests = KRH(
+        template_files=harness.charm._template_files,
+        context=harness.charm._context,
+        field_manager="spark-k8s",
+    ).render_manifests()
+    deployment = next(
+        manifest for manifest in manifests if manifest.metadata.name == "spark-k8s-pushgateway"
+    )
+    container = deployment.spec.template.spec.containers[0]
+    assert container.args == ["--web.listen-address=:9091"]
+    assert container.resources.limits == {"memory": "256Mi"}
+    assert container.resources.requests["memory"] == "256Mi"
+    assert container.env[0].to_dict() == {"name": "GOMEMLIMIT", "value": "241591910"}
+
+    url = "http://spark-k8s-pushgateway.kubeflow.svc:9091"
+    spark_defaults = harness.charm.container.pull("/opt/spark/conf/spark-defaults.conf").read()
+    assert f"spark.executorEnv.PUSHGATEWAY_URL {url}" in spark_defaults
+    assert {
+        "job_name": "pushgateway",
+        "static_configs": [{"targets": ["spark-k8s-pushgateway.kubeflow.svc:9091"]}],
+    } in harness.charm._scrape_jobs
+    # The Pushgateway is not part of the unit pods
+    assert "pushgateway" not in harness.model.unit.containers
+    assert ("Deployment", "spark-k8s-pushgateway") not in [
+        (resource.__name__, name) for resource, name in harness.charm._disabled_resources
+    ]
+
+    harness.update_config({"pushgateway-memory-limit": "256MiB"})
+    assert harness.charm.unit.status == BlockedStatus("Invalid pushgateway-memory-limit: 256MiB")
+
+    harness.update_config({"enable-pushgateway": False})
+    assert ("Deployment", "spark-k8s-pushgateway") in [
+        (resource.__name__, name) for resource, name in harness.charm._disabled_resources
+    ]
+
+
+def test_history_server_enabled(
+    harness,
+    mocked_lightkube_client,
+    mocked_cert,
+    mocked_kubernetes_service_patcher,
+    mocked_resource_handler,
+):
+    harness.begin()
+    harness.container_pebble_ready("spark")
+
+    plan = harness.get_container_pebble_plan("spark").to_dict()["services"]
+    assert plan["history-server"]["startup"] == "disabled"
+
+    harness.update_config({"enable-history-server": True, "event-log-dir": "s3a://events"})
+    assert harness.charm.unit.status == BlockedStatus(
+        "Add spark-history storage to run the History Server"
+    )
+    plan = harness.get_container_pebble_plan("spark").to_dict()["services"]
+    assert plan["history-server"]["startup"] == "disabled"
+
+    harness.add_storage("spark-history")
+    harness.update_config({"event-log-dir": ""})
+    # Nothing would write events the History Server can read
+    assert harness.charm.unit.status == BlockedStatus(
+        "Set event-log-dir to run the History Server"
+    )
+    plan = harness.get_container_pebble_plan("spark").to_dict()["services"]
+    assert plan["history-server"]["startup"] == "disabled"
+    spark_defaults = harness.charm.container.pull("/opt/spark/conf/spark-defaults.conf").read()
+    assert "spark.eventLog.enabled" not in spark_defaults
+
+    harness.update_config({"event-log-dir": "s3a://events"})
+    plan = harness.get_container_pebble_plan("spark").to_dict()["services"]
+    history_opts = plan["history-server"]["environment"]["SPARK_HISTORY_OPTS"]
+    assert plan["history-server"]["startup"] == "enabled"
+    assert "-Dspark.history.fs.logDirectory=s3a://events" in history_opts
+    assert "-Dspark.history.retainedApplications=50" in history_opts
+
+    spark_defaults = harness.charm.container.pull("/opt/spark/conf/spark-defaults.conf").read()
+    assert "spark.eventLog.dir s3a://events" in spark_defaults
+
+
+def test_dynamic_allocation_external_shuffle_service(
+    harness,
+    mocked_lightkube_client,
+    mocked_cert,
+    mocked_kubernetes_service_patcher,
+    mocked_resource_handler,
+):
+    harness.begin()
+    harness.container_pebble_ready("spark")
+    assert harness.charm._context["shuffle_service_enabled"] is False
+
+    harness.update_config({"dynamic-allocation": "external-shuffle-service"})
+    assert harness.charm._context["shuffle_service_enabled"] is True
+
+    spark_defaults = harness.charm.container.pull("/opt/spark/conf/spark-defaults.conf").read()
+    assert "spark.dynamicAllocation.enabled true" in spark_defaults
+    assert "spark.shuffle.service.enabled true" in spark_defaults
+    pod_template = harness.charm.container.pull(
+        "/etc/spark-k8s/pod-templates/default/default/executor.yaml"
+    )
+    assert "hostNetwork: true" in pod_template.read()
+
+    harness.update_config({"dynamic-allocation": "static"})
+    assert isinstance(harness.charm.unit.status, BlockedStatus)
+
+
+def test_shuffle_service_template_renders(
+    harness, mocked_lightkube_client, mocked_cert, mocked_kubernetes_service_patcher
+):
+    harness.update_config({"dynamic-allocation": "external-shuffle-service"})
+    harness.begin()
+
+    manifests = KRH(
+        template_files=harness.charm._template_files,
+        context=harness.charm._context,
+        field_manager="spark-k8s",
+    ).render_manifests()
+
+    daemon_set = next(
+        manifest
+        for manifest in manifests
+        if manifest.kind == "DaemonSet" and manifest.metadata.name == "spark-k8s-shuffle-service"
+    )
+    # Executors running as the Spark user create their blockmgr dirs in the shuffle dir
+    (init,) = daemon_set.spec.template.spec.initContainers
+    assert init.command == ["chmod", "1777", "/var/lib/spark-shuffle"]
+    assert init.securityContext.runAsUser == 0
+    assert init.volumeMounts[0].mountPath == "/var/lib/spark-shuffle"
+
+
+def test_performance_profile_applies_at_submission(
+    harness,
+    mocker,
+    mocked_lightkube_client,
+    mocked_cert,
+    mocked_kubernetes_service_patcher,
+    mocked_resource_handler,
+):
+    benchmark = mocker.patch("charm.SubmissionBenchmark")
+    benchmark.return_value.run.return_value = {}
+    harness.begin()
+    params = {"count": 1, "concurrency": 1, "timeout": 60, "cleanup": True}
+
+    harness.charm._on_benchmark_submission_action(MagicMock(params=params))
+    submitted = benchmark.call_args.args[1]
+    assert "spark.kubernetes.memoryOverheadFactor" not in submitted["spec"].get("sparkConf", {})
+
+    harness.charm._on_benchmark_submission_action(
+        MagicMock(params={**params, "profile": "memory-constrained"})
+    )
+    submitted = benchmark.call_args.args[1]
+    # Submission-time settings of the profile reach spark-submit through the sparkConf
+    assert submitted["spec"]["sparkConf"]["spark.kubernetes.memoryOverheadFactor"] == "0.2"
+    assert submitted["spec"]["sparkConf"]["spark.kubernetes.allocation.batch.size"] == "5"
+
+    event = MagicMock(params={**params, "profile": "unknown"})
+    harness.charm._on_benchmark_submission_action(event)
+    event.fail.assert_called_once_with("Unknown performance profile: unknown")
+
+
+def test_benchmark_cleans_up_after_failed_run(
+    harness,
+    mocker,
+    mocked_lightkube_client,
+    mocked_cert,
+    mocked_kubernetes_service_patcher,
+    mocked_resource_handler,
+):
+    benchmark = mocker.patch("charm.SubmissionBenchmark")
+    benchmark.return_value.run_id = "abc123"
+    benchmark.return_value.run.side_effect = ApiError(status=Status(code=409, message="conflict"))
+    harness.begin()
+    event = MagicMock(params={"count": 4, "concurrency": 2, "timeout": 60, "cleanup": True})
+
+    harness.charm._on_benchmark_submission_action(event)
+
+    # The applications submitted before the failure are deleted too
+    benchmark.return_value.cleanup.assert_called_once_with()
+    event.fail.assert_called_once_with("Benchmark run abc123 failed: conflict")
+    event.set_results.assert_not_called()
+
+
+def test_invalid_performance_profiles(
+    harness,
+    mocked_lightkube_client,
+    mocked_cert,
+    mocked_kubernetes_service_patcher,
+    mocked_resource_handler,
+):
+    harness.begin()
+    harness.container_pebble_ready("spark")
+
+    harness.update_config({"performance-profiles": "Fast_Profile: {}"})
+
+    assert harness.charm.unit.status == BlockedStatus(
+        "Invalid performance profile name: Fast_Profile"
+    )
+
+
+def test_spark_relation_data(
+    harness,
+    mocked_lightkube_client,
+    mocked_cert,
+    mocked_kubernetes_service_patcher,
+    mocked_resource_handler,
+):
+    harness.set_model_name("kubeflow")
+    harness.begin()
+    mocked_lightkube_client.return_value.list.return_value = []
+    relation_id = harness.add_relation("spark", "spark-client")
+    harness.add_relation_unit(relation_id, "spark-client/0")
+
+    data = harness.get_relation_data(relation_id, "spark-k8s")
+    assert data["version"] == "2"
+    assert data["namespace"] == "kubeflow"
+    assert data["service-account"] == "spark-k8s-driver-account"
+    throughput = json.loads(data["profiles"])["throughput"]
+    assert throughput["spark.sql.shuffle.partitions"] == "400"
+
+    harness.update_config({"spark-image": "spark:3.3"})
+    assert harness.get_relation_data(relation_id, "spark-k8s")["image"] == "spark:3.3"
+
+
+def test_tmpfs_scratch_space(
+    harness,
+    mocked_lightkube_client,
+    mocked_cert,
+    mocked_kubernetes_service_patcher,
+    mocked_resource_handler,
+):
+    harness.begin()
+    harness.container_pebble_ready("spark")
+
+    harness.update_config({"scratch-space": "tmpfs", "scratch-space-size": "4Gi"})
+
+    spark_defaults = harness.charm.container.pull("/opt/spark/conf/spark-defaults.conf").read()
+    for role in ["driver", "executor"]:
+        volume = f"spark.kubernetes.{role}.volumes.emptyDir.spark-local-dir-scratch"
+        assert f"{volume}.mount.path /var/lib/spark-scratch" in spark_defaults
+        assert f"{volume}.options.medium Memory" in spark_defaults
+        assert f"{volume}.options.sizeLimit 4Gi" in spark_defaults
+
+
+def test_scratch_space_with_external_shuffle_service(
+    harness,
+    mocked_lightkube_client,
+    mocked_cert,
+    mocked_kubernetes_service_patcher,
+    mocked_resource_handler,
+):
+    harness.begin()
+    harness.container_pebble_ready("spark")
+
+    harness.update_config(
+        {"scratch-space": "disk", "dynamic-allocation": "external-shuffle-service"}
+    )
+
+    spark_defaults = harness.charm.container.pull("/opt/spark/conf/spark-defaults.conf").read()
+    executor_local_dirs = [
+        line.split()[0]
+        for line in spark_defaults.splitlines()
+        if line.startswith("spark.kubernetes.executor.volumes.")
+        and ".spark-local-dir-" in line
+        and line.split()[0].endswith(".mount.path")
+    ]
+    # The shuffle service only serves the blocks in the shared shuffle dir
+    assert executor_local_dirs == [
+        "spark.kubernetes.executor.volumes.hostPath.spark-local-dir-shuffle.mount.path"
+    ]
+    assert (
+        "spark.kubernetes.driver.volumes.emptyDir.spark-local-dir-scratch.mount.path "
+        "/var/lib/spark-scratch"
+    ) in spark_defaults
+    assert harness.charm.unit.status == ActiveStatus()
+
+
+def test_placement_policy(
+    harness,
+    mocked_lightkube_client,
+    mocked_cert,
+    mocked_kubernetes_service_patcher,
+    mocked_resource_handler,
+):
+    harness.begin()
+    harness.container_pebble_ready("spark")
+
+    harness.update_config({"placement-policy": "spread"})
+
+    spark_defaults = harness.charm.container.pull("/opt/spark/conf/spark-defaults.conf").read()
+    assert (
+        "spark.kubernetes.executor.podTemplateFile "
+        "/etc/spark-k8s/pod-templates/spread/default/executor.yaml"
+    ) in spark_defaults
+    spread = yaml.safe_load(
+        harness.charm.container.pull("/etc/spark-k8s/pod-templates/spread/default/executor.yaml")
+    )
+    assert spread["spec"]["topologySpreadConstraints"][0]["maxSkew"] == 1
+    bin_pack = yaml.safe_load(
+        harness.charm.container.pull("/etc/spark-k8s/pod-templates/bin-pack/default/driver.yaml")
+    )
+    assert "podAffinity" in bin_pack["spec"]["affinity"]
+
+    harness.update_config({"placement-policy": "random"})
+    assert isinstance(harness.charm.unit.status, BlockedStatus)
+
+
+def test_image_prepull(
+    harness,
+    mocked_lightkube_client,
+    mocked_cert,
+    mocked_kubernetes_service_patcher,
+):
+    harness.update_config({"prepull-images": "spark:3.1.1, spark:3.3.0"})
+    harness.begin()
+
+    manifests = KRH(
+        template_files=harness.charm._template_files,
+        context=harness.charm._context,
+        field_manager="spark-k8s",
+    ).render_manifests()
+    (prepull,) = [manifest for manifest in manifests if manifest.kind == "DaemonSet"]
+    assert [container.image for container in prepull.spec.template.spec.initContainers] == [
+        "spark:3.1.1",
+        "spark:3.3.0",
+    ]
+
+    daemon_set = mocked_lightkube_client.return_value.get.return_value
+    daemon_set.status.numberReady, daemon_set.status.desiredNumberScheduled = 2, 5
+    harness.charm.unit.status = ActiveStatus()
+    harness.charm.on.update_status.emit()
+    assert harness.charm.unit.status == ActiveStatus("Pre-pulling images: 2/5 nodes")
+
+
+def test_priority_classes(
+    harness,
+    mocked_lightkube_client,
+    mocked_cert,
+    mocked_kubernetes_service_patcher,
+    mocked_resource_handler,
+):
+    harness.set_model_name("kubeflow")
+    harness.begin()
+    harness.container_pebble_ready("spark")
+
+    harness.update_config({"default-priority-tier": "production"})
+
+    spark_defaults = harness.charm.container.pull("/opt/spark/conf/spark-defaults.conf").read()
+    assert (
+        "spark.kubernetes.driver.podTemplateFile "
+        "/etc/spark-k8s/pod-templates/default/production/driver.yaml"
+    ) in spark_defaults
+    batch = yaml.safe_load(
+        harness.charm.container.pull("/etc/spark-k8s/pod-templates/spread/batch/executor.yaml")
+    )
+    assert batch["spec"]["priorityClassName"] == "kubeflow-spark-k8s-batch"
+
+    harness.update_config({"default-priority-tier": "critical"})
+    assert isinstance(harness.charm.unit.status, BlockedStatus)
+
+
+def test_priority_classes_render(
+    harness, mocked_lightkube_client, mocked_cert, mocked_kubernetes_service_patcher
+):
+    harness.set_model_name("kubeflow")
+    harness.begin()
+
+    manifests = KRH(
+        template_files=harness.charm._template_files,
+        context=harness.charm._context,
+        field_manager="spark-k8s",
+    ).render_manifests()
+    priority_classes = {
+        manifest.metadata.name: manifest
+        for manifest in manifests
+        if manifest.kind == "PriorityClass"
+    }
+
+    assert priority_classes["kubeflow-spark-k8s-production"].value == 100000
+    assert priority_classes["kubeflow-spark-k8s-batch"].preemptionPolicy == "Never"
+    assert (
+        priority_classes["kubeflow-spark-k8s-batch"].metadata.labels["spark-k8s.charm/model"]
+        == "kubeflow"
+    )
+
+
+def test_prune_priority_classes_of_this_application(
+    harness,
+    mocked_lightkube_client,
+    mocked_cert,
+    mocked_kubernetes_service_patcher,
+    mocked_resource_handler,
+):
+    harness.set_model_name("kubeflow")
+    harness.begin()
+    client = mocked_lightkube_client.return_value
+    client.list.return_value = [
+        PriorityClass(metadata=ObjectMeta(name="kubeflow-spark-k8s-legacy"), value=1)
+    ]
+
+    harness.charm._prune_priority_classes({"batch": 0})
+
+    (resource,), kwargs = client.list.call_args
+    assert resource is PriorityClass
+    # A sibling application named spark-k8s-batch shares the name prefix, not the labels
+    assert kwargs["labels"]["app.juju.is/created-by"] == "spark-k8s"
+    assert kwargs["labels"]["spark-k8s.charm/model"] == "kubeflow"
+    client.delete.assert_called_once_with(PriorityClass, "kubeflow-spark-k8s-legacy")
+
+
+def test_prune_applications(
+    harness,
+    spark_application,
+    mocked_lightkube_client,
+    mocked_cert,
+    mocked_kubernetes_service_patcher,
+    mocked_resource_handler,
+):
+    harness.update_config({"application-ttl": 3600})
+    (storage_id,) = harness.add_storage("archive")
+    harness.begin()
+    Path(harness.charm.model.storages["archive"][0].location).mkdir(parents=True)
+    mocked_lightkube_client.return_value.list.return_value = [
+        spark_application("finished"),
+        spark_application("running", state="RUNNING"),
+        spark_application("recent", terminated=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())),
+    ]
+
+    harness.charm.on.update_status.emit()
+
+    mocked_lightkube_client.return_value.delete.assert_called_once_with(
+        SparkApplication, "finished"
+    )
+    event = MagicMock(params={"limit": 10})
+    harness.charm._on_query_archive_action(event)
+    results = event.set_results.call_args.args[0]
+    assert results["count"] == 1
+    assert json.loads(results["records"])[0]["name"] == "finished"
+
+
+def test_prune_applications_without_archive(
+    harness,
+    spark_application,
+    mocked_lightkube_client,
+    mocked_cert,
+    mocked_kubernetes_service_patcher,
+    mocked_resource_handler,
+):
+    harness.update_config({"application-ttl": 3600})
+    harness.begin()
+    mocked_lightkube_client.return_value.list.return_value = [spark_application("finished")]
+
+    harness.charm.on.update_status.emit()
+
+    mocked_lightkube_client.return_value.delete.assert_not_called()
+    event = MagicMock(params={})
+    harness.charm._on_query_archive_action(event)
+    event.fail.assert_called_once_with("Archive storage not attached")
+
+
+def driver_pod(application, ip):
+    """Driver pod as the operator names and labels it."""
+    return Pod(
+        metadata=ObjectMeta(
+            name=f"{application}-driver",
+            labels={
+                "spark-role": "driver",
+                "sparkoperator.k8s.io/app-name": application,
+                "sparkoperator.k8s.io/launched-by-spark-operator": "true",
+            },
+        ),
+        status=PodStatus(phase="Running", podIP=ip),
+    )
+
+
+def test_ui_proxy_replaces_ui_services(
+    harness,
+    mocked_lightkube_client,
+    mocked_cert,
+    mocked_kubernetes_service_patcher,
+    mocked_resource_handler,
+):
+    harness.set_model_name("kubeflow")
+    harness.begin()
+    harness.container_pebble_ready("spark")
+    client = mocked_lightkube_client.return_value
+    client.list.side_effect = lambda resource, **kwargs: (
+        [driver_pod("spark-pi", "10.1.0.7"), driver_pod("word-count", "10.1.0.9")]
+        if resource is Pod
+        else []
+    )
+
+    harness.update_config(
+        {"enable-ui-service": False, "enable-ui-proxy": True, "ui-ingress-host": "spark.local"}
+    )
+
+    command = harness.get_container_pebble_plan("spark").to_dict()["services"]["spark"]["command"]
+    assert "-enable-ui-service=false " in command
+
+    client.list.assert_any_call(
+        Pod,
+        labels={
+            "spark-role": "driver",
+            "sparkoperator.k8s.io/launched-by-spark-operator": "true",
+        },
+        fields={"status.phase": "Running"},
+    )
+    manifests = KRH(
+        template_files=harness.charm._template_files,
+        context=harness.charm.resource_handler.context,
+        field_manager="spark-k8s",
+    ).render_manifests()
+    kinds = [(m.kind, m.metadata.name) for m in manifests if "ui" in m.metadata.name]
+    assert ("Deployment", "spark-k8s-ui-proxy") in kinds
+    assert ("Ingress", "spark-k8s-ui-proxy") in kinds
+    config = next(m for m in manifests if m.kind == "ConfigMap" and "ui" in m.metadata.name)
+    # /spark-pi/ reaches the pod spark-pi-driver of the application spark-pi
+    drivers = config.data["drivers.map"].split()
+    assert drivers == ["spark-pi", "10.1.0.7;", "word-count", "10.1.0.9;"]
+    assert "proxy_pass http://$driver:4040$path$is_args$args;" in config.data["default.conf"]
+    assert "return 301 /$application/$is_args$args;" in config.data["default.conf"]
+
+    # Only the leader looks the drivers up, and applies the manifests
+    client.list.reset_mock()
+    harness.set_leader(False)
+    harness.charm.on.update_status.emit()
+    harness.update_config({"ui-ingress-host": "spark.example"})
+    assert Pod not in [call.args[0] for call in client.list.call_args_list]
+
+
+def test_remove_deletes_applications_before_crds(
+    harness,
+    spark_application,
+    mocked_lightkube_client,
+    mocked_cert,
+    mocked_kubernetes_service_patcher,
+    mocked_resource_handler,
+):
+    harness.begin()
+    client = mocked_lightkube_client.return_value
+    client.list.side_effect = lambda resource, **kwargs: (
+        [spark_application(f"app-{i}") for i in range(3)] if resource is SparkApplication else []
+    )
+    mocked_resource_handler.return_value.render_manifests.return_value = [
+        CustomResourceDefinition(
+            metadata=ObjectMeta(name="sparkapplications.sparkoperator.k8s.io"), spec=MagicMock()
+        )
+    ]
+
+    harness.set_planned_units(0)
+    harness.charm._on_remove(None)
+
+    deleted = [call.args[:2] for call in client.delete.call_args_list]
+    assert sorted(deleted[:3]) == [(SparkApplication, f"app-{i}") for i in range(3)]
+    assert sorted(name for _, name in deleted[3:]) == [
+        "spark-k8s-webhook-config",
+        "sparkapplications.sparkoperator.k8s.io",
+    ]
+    assert harness.charm.unit.status == MaintenanceStatus("Removing: deleted 3 SparkApplications")
+
+
+def test_remove_without_crds(
+    harness,
+    mocked_lightkube_client,
+    mocked_cert,
+    mocked_kubernetes_service_patcher,
+    mocked_resource_handler,
+):
+    harness.begin()
+    client = mocked_lightkube_client.return_value
+
+    def missing_crd(resource, **kwargs):
+        # lightkube only sends the request once the list is iterated
+        raise ApiError(status=Status(code=404, message="not found"))
+        yield
+
+    client.list.side_effect = missing_crd
+    mocked_resource_handler.return_value.render_manifests.return_value = [
+        ConfigMap(metadata=ObjectMeta(name="spark-k8s-config"), data={"a": "1"})
+    ]
+
+    harness.set_planned_units(0)
+    harness.charm._on_remove(None)
+
+    # The rest of the teardown still runs
+    deleted = sorted(call.args[1] for call in client.delete.call_args_list)
+    assert deleted == ["spark-k8s-config", "spark-k8s-webhook-config"]
+
+
+def test_upgrade_applies_only_changed_manifests(
+    harness,
+    mocker,
+    mocked_lightkube_client,
+    mocked_cert,
+    mocked_kubernetes_service_patcher,
+    mocked_resource_handler,
+):
+    apply_many = mocker.patch("charm.apply_many")
+    resource_handler = mocked_resource_handler.return_value
+    resource_handler.render_manifests.return_value = [
+        ConfigMap(metadata=ObjectMeta(name="unchanged"), data={"a": "1"}),
+        ConfigMap(metadata=ObjectMeta(name="changed"), data={"a": "1"}),
+    ]
+    harness.begin()
+    harness.container_pebble_ready("spark")
+    assert harness.charm._apply_resources()
+    replan = mocker.spy(harness.charm.container, "replan")
+
+    resource_handler.render_manifests.return_value = [
+        ConfigMap(metadata=ObjectMeta(name="unchanged"), data={"a": "1"}),
+        ConfigMap(metadata=ObjectMeta(name="changed"), data={"a": "2"}),
+        ConfigMap(metadata=ObjectMeta(name="new")),
+    ]
+    harness.charm.on.upgrade_charm.emit()
+
+    applied = apply_many.call_args.kwargs["objs"]
+    assert [manifest.metadata.name for manifest in applied] == ["changed", "new"]
+    resource_handler.apply.assert_called_once()
+    replan.assert_not_called()
+    assert harness.charm.unit.status == ActiveStatus()
+
+
+def test_failed_cleanup_is_retried(
+    harness,
+    mocker,
+    mocked_lightkube_client,
+    mocked_cert,
+    mocked_kubernetes_service_patcher,
+    mocked_resource_handler,
+):
+    mocker.patch("charm.apply_many")
+    mocked_resource_handler.return_value.render_manifests.return_value = [
+        ConfigMap(metadata=ObjectMeta(name="spark-k8s-config"), data={"a": "1"})
+    ]
+    harness.begin()
+    harness.container_pebble_ready("spark")
+    delete = mocked_lightkube_client.return_value.delete
+    delete.side_effect = ApiError(status=Status(code=500, message="unavailable"))
+
+    mocked_resource_handler.return_value.render_manifests.return_value = [
+        ConfigMap(metadata=ObjectMeta(name="spark-k8s-config"), data={"a": "2"})
+    ]
+    harness.charm.on.config_changed.emit()
+    assert harness.charm.unit.status == BlockedStatus("ApiError: 500")
+
+    delete.reset_mock()
+    delete.side_effect = None
+    harness.charm.on.config_changed.emit()
+
+    # The manifests did not change, but the deletes failed last time
+    delete.assert_any_call(DaemonSet, "spark-k8s-image-prepull")
+
+
+def test_failed_service_patch_is_retried(
+    harness,
+    mocker,
+    mocked_lightkube_client,
+    mocked_cert,
+    mocked_kubernetes_service_patcher,
+    mocked_resource_handler,
+):
+    harness.begin()
+    service_patch = mocker.patch.object(harness.charm.service_patcher, "_patch")
+    # As before `juju trust`, the patcher logs the 403 and leaves the ports
+    mocker.patch.object(harness.charm.service_patcher, "is_patched", return_value=False)
+
+    harness.charm.on.config_changed.emit()
+    harness.charm.on.config_changed.emit()
+    assert service_patch.call_count == 2
+
+    harness.charm.service_patcher.is_patched.return_value = True
+    harness.charm.on.config_changed.emit()
+    harness.charm.on.config_changed.emit()
+    assert service_patch.call_count == 3
+
+
+def test_reconcile_skips_work_already_done(
+    harness,
+    mocker,
+    mocked_lightkube_client,
+    mocked_cert,
+    mocked_kubernetes_service_patcher,
+    mocked_resource_handler,
+):
+    apply_many = mocker.patch("charm.apply_many")
+    mocked_resource_handler.return_value.render_manifests.return_value = [
+        ConfigMap(metadata=ObjectMeta(name="spark-k8s-config"), data={"a": "1"})
+    ]
+    harness.begin()
+    harness.container_pebble_ready("spark")
+    service_patch = mocker.patch.object(harness.charm.service_patcher, "_patch")
+    replan = mocker.spy(harness.charm.container, "replan")
+    delete = mocked_lightkube_client.return_value.delete
+    delete.reset_mock()
+
+    harness.charm.on.config_changed.emit()
+
+    # Applied, patched and planned on spark-pebble-ready already
+    assert apply_many.call_args.kwargs["objs"] == []
+    service_patch.assert_not_called()
+    replan.assert_not_called()
+    delete.assert_not_called()
+    assert harness.charm.unit.status == ActiveStatus()
+
+
+def test_operator_readiness_gates_status(
+    harness,
+    mocker,
+    mocked_operator_ready,
+    mocked_lightkube_client,
+    mocked_cert,
+    mocked_kubernetes_service_patcher,
+    mocked_resource_handler,
+):
+    mocker.patch("charm.SparkCharm._ready_timeout", 0)
+    mocked_operator_ready.return_value = False
+    harness.begin()
+
+    harness.container_pebble_ready("spark")
+    layer = harness.charm._spark_operator_layer.to_dict()
+    assert layer["checks"]["operator-metrics"]["http"]["url"] == "http://localhost:10254/metrics"
+    assert layer["checks"]["operator-webhook"]["tcp"]["port"] == 443
+    assert set(layer["services"]["spark"]["on-check-failure"]) == set(layer["checks"])
+    assert harness.charm.unit.status == WaitingStatus("Waiting for the operator to become ready")
+
+    mocked_operator_ready.return_value = True
+    harness.charm.on.update_status.emit()
+    assert harness.charm.unit.status == ActiveStatus()
+    assert len(harness.charm.charm_metrics._durations["time_to_ready"]) == 1
+
+
+def test_webhook_key_algorithm_rotation(
+    harness,
+    mocker,
+    mocked_lightkube_client,
+    mocked_cert,
+    mocked_kubernetes_service_patcher,
+    mocked_resource_handler,
+):
+    harness.begin()
+    mocked_cert.assert_called_once_with("ecdsa-p256")
+    harness.container_pebble_ready("spark")
+    restart = mocker.spy(harness.charm.container, "restart")
+
+    # Certs of deployments from before the algorithm was configurable are kept
+    harness.charm._stored.key_algorithm = ""
+    harness.charm._update_certs()
+    assert mocked_cert.call_count == 1
+
+    mocked_cert.return_value = {"cert": "ecdsa-cert", "key": "ecdsa-key", "ca": "ecdsa-ca"}
+    harness.update_config({"webhook-key-algorithm": "ecdsa-p256"})
+    harness.charm._update_certs()
+    harness.charm.on.config_changed.emit()
+
+    assert harness.charm.container.pull("/etc/webhook-certs/server-key.pem").read() == "ecdsa-key"
+    restart.assert_called_once_with("spark")
+
+    harness.update_config({"webhook-key-algorithm": "dsa"})
+    assert harness.charm.unit.status == BlockedStatus(
+        "webhook-key-algorithm must be one of ecdsa-p256, rsa-2048"
+    )
+
+
+def test_webhook_restricted_to_spark_pods(
+    harness,
+    mocked_lightkube_client,
+    mocked_cert,
+    mocked_kubernetes_service_patcher,
+    mocked_resource_handler,
+):
+    selector = {
+        "matchExpressions": [
+            {"key": "spark-role", "operator": "In", "values": ["driver", "executor"]}
+        ]
+    }
+    client = mocked_lightkube_client.return_value
+    client.get.return_value = MutatingWebhookConfiguration.from_dict(
+        {"metadata": {"name": "spark-k8s-webhook-config"}, "webhooks": [webhook()]}
+    )
+    harness.begin()
+
+    harness.container_pebble_ready("spark")
+
+    client.patch.assert_called_once_with(
+        MutatingWebhookConfiguration,
+        "spark-k8s-webhook-config",
+        {"webhooks": [{"name": "webhook.sparkoperator.k8s.io", "objectSelector": selector}]},
+    )
+    client.patch.reset_mock()
+    client.get.return_value = MutatingWebhookConfiguration.from_dict(
+        {"metadata": {"name": "spark-k8s-webhook-config"}, "webhooks": [webhook(selector)]}
+    )
+    harness.charm.on.update_status.emit()
+    client.patch.assert_not_called()
+
+
+def test_webhook_restored_after_removal(
+    harness,
+    mocked_lightkube_client,
+    mocked_cert,
+    mocked_kubernetes_service_patcher,
+    mocked_resource_handler,
+):
+    client = mocked_lightkube_client.return_value
+    harness.set_model_name("kubeflow")
+    harness.begin()
+    harness.container_pebble_ready("spark")
+    client.create.reset_mock()
+
+    # The operator of another unit deleted it when it stopped
+    client.get.side_effect = ApiError(status=Status(code=404, message="not found"))
+    harness.charm.on.update_status.emit()
+
+    client.create.assert_called_once()
+    config = client.create.call_args.args[0]
+    assert config.metadata.name == "spark-k8s-webhook-config"
+    (restored,) = config.webhooks
+    assert restored.clientConfig.service.to_dict() == {
+        "name": "spark-k8s",
+        "namespace": "kubeflow",
+        "path": "/webhook",
+        "port": 443,
+    }
+    assert base64.b64decode(restored.clientConfig.caBundle).decode() == "fake-ca-cert"
+    assert restored.namespaceSelector.matchLabels == {"model.juju.is/name": "kubeflow"}
+    assert restored.objectSelector.matchExpressions[0].values == ["driver", "executor"]
+    assert harness.charm.unit.status == ActiveStatus()
+
+
+def test_remove_unit_keeps_resources(
+    harness,
+    mocked_lightkube_client,
+    mocked_cert,
+    mocked_kubernetes_service_patcher,
+    mocked_resource_handler,
+):
+    harness.set_planned_units(2)
+    harness.begin()
+
+    harness.charm._on_remove(None)
+
+    mocked_lightkube_client.return_value.delete.assert_not_called()
+
+
+def test_scaled_out_units_share_certs(
+    harness,
+    mocked_lightkube_client,
+    mocked_cert,
+    mocked_kubernetes_service_patcher,
+    mocked_resource_handler,
+):
+    leader = harness
+    relation_id = leader.add_relation("replicas", "spark-k8s")
+    leader.begin()
+    leader.container_pebble_ready("spark")
+    shared = leader.get_relation_data(relation_id, "spark-k8s")
+    assert shared == {
+        "cert": "fake-cert",
+        "key": "fake-server-key",
+        "ca": "fake-ca-cert",
+        "key-algorithm": "ecdsa-p256",
+    }
+    command = leader.get_container_pebble_plan("spark").services["spark"].command
+    assert "-leader-election=true -leader-election-lock-namespace=" in command
+
+    unit = Harness(SparkCharm)
+    unit.set_leader(False)
+    relation_id = unit.add_relation("replicas", "spark-k8s")
+    unit.begin()
+    unit.container_pebble_ready("spark")
+    assert unit.charm.unit.status == WaitingStatus("Waiting for the webhook certs from the leader")
+
+    unit.update_relation_data(relation_id, "spark-k8s", shared)
+    mocked_cert.assert_called_once()
+    assert unit.charm.container.pull("/etc/webhook-certs/server-cert.pem").read() == "fake-cert"
+    # Every unit serves the webhook, the election picks the one running the controller
+    assert unit.charm.container.get_service("spark").is_running()
+    assert unit.charm.unit.status == ActiveStatus()
+    assert unit.get_container_pebble_plan("spark").services["spark"].command == command
+
+
+def test_former_leader_keeps_serving_webhook(
+    harness,
+    mocked_lightkube_client,
+    mocked_cert,
+    mocked_kubernetes_service_patcher,
+    mocked_resource_handler,
+):
+    harness.add_relation("replicas", "spark-k8s")
+    harness.begin()
+    harness.container_pebble_ready("spark")
+    command = harness.get_container_pebble_plan("spark").services["spark"].command
+
+    harness.set_leader(False)
+    harness.update_config({"metrics-port": 10255})
+
+    # The operators elect the controller among themselves, independently of Juju
+    plan = harness.get_container_pebble_plan("spark").services["spark"]
+    assert plan.startup == "enabled"
+    assert "-leader-election=true " in plan.command
+    assert plan.command.replace("10255", "10254") == command
+    assert harness.charm.container.get_service("spark").is_running()
+    assert harness.charm.unit.status == ActiveStatus()
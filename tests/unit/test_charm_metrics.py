@@ -0,0 +1,52 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+from types import SimpleNamespace
+
+import httpx
+
+from charm_metrics import CharmMetrics
+
+
+def test_merge_accumulates_across_hooks():
+    state = ""
+    for hook in ["install", "config-changed"]:
+        metrics = CharmMetrics(hook=hook, buckets=[1.0])
+        metrics.observe("apply", 0.5)
+        metrics.observe("apply", 2.0)
+        for _ in range(3):
+            metrics._count_request(None)
+        state = metrics.merge(state)
+
+    rendered = metrics.render(state)
+
+    assert (
+        'spark_k8s_charm_operation_duration_seconds_bucket{operation="apply",le="1.0"} 2'
+        in rendered
+    )
+    assert 'spark_k8s_charm_operation_duration_seconds_count{operation="apply"} 4' in rendered
+    assert 'spark_k8s_charm_hook_duration_seconds_count{hook="install"} 1' in rendered
+    assert 'spark_k8s_charm_api_requests_total{hook="config-changed"} 3' in rendered
+
+
+def test_timer_records_duration():
+    metrics = CharmMetrics(hook="install")
+    with metrics.timer("update_layer"):
+        pass
+
+    rendered = metrics.render(metrics.merge(""))
+
+    assert 'duration_seconds_count{operation="update_layer"} 1' in rendered
+
+
+def test_instrument_counts_sent_requests():
+    metrics = CharmMetrics(hook="install")
+    http = httpx.Client(transport=httpx.MockTransport(lambda request: httpx.Response(404)))
+    # A lightkube Client wraps its httpx client in a generic client
+    metrics.instrument(SimpleNamespace(_client=SimpleNamespace(_client=http)))
+
+    http.get("http://localhost/api/v1/namespaces/kubeflow/pods")
+    http.delete("http://localhost/api/v1/namespaces/kubeflow/pods/spark-pi-driver")
+
+    assert 'spark_k8s_charm_api_requests_total{hook="install"} 2' in metrics.render(
+        metrics.merge("")
+    )
@@ -0,0 +1,68 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+import copy
+from pathlib import Path
+
+import jsonschema
+import pytest
+import yaml
+from jinja2 import Template
+
+from crd_schema import slim_crds_template
+
+
+def schemas(template_file: str, slim_crds: bool) -> dict:
+    rendered = Template(Path(template_file).read_text()).render(
+        app_name="spark-k8s", slim_crds=slim_crds
+    )
+    return {
+        crd["spec"]["names"]["kind"]: crd["spec"]["versions"][0]["schema"]["openAPIV3Schema"]
+        for crd in yaml.safe_load_all(rendered)
+        if crd
+    }
+
+
+def spark_pi() -> dict:
+    app = yaml.safe_load(Path("examples/spark-pi.yaml").read_text())
+    app["spec"]["driver"].update(
+        {
+            "affinity": {
+                "podAntiAffinity": {"preferredDuringSchedulingIgnoredDuringExecution": []}
+            },
+            "sidecars": [{"name": "logs", "image": "busybox", "args": ["tail", "-f"]}],
+            "securityContext": {"runAsUser": 185},
+        }
+    )
+    app["spec"]["volumes"] = [{"name": "scratch", "emptyDir": {"medium": "Memory"}}]
+    return app
+
+
+def test_slim_crds_are_up_to_date():
+    assert (
+        slim_crds_template(Path("src/crds.yaml").read_text())
+        == Path("src/crds-slim.yaml").read_text()
+    )
+
+
+def test_one_crd_template_is_selected():
+    assert schemas("src/crds.yaml", slim_crds=True) == {}
+    assert schemas("src/crds-slim.yaml", slim_crds=False) == {}
+
+
+@pytest.mark.parametrize("slim_crds", [False, True])
+def test_schemas_accept_example_application(slim_crds):
+    template_file = "src/crds-slim.yaml" if slim_crds else "src/crds.yaml"
+    schema = schemas(template_file, slim_crds)["SparkApplication"]
+    app = spark_pi()
+
+    jsonschema.validate(app, schema)
+    scheduled = schemas(template_file, slim_crds)["ScheduledSparkApplication"]
+    jsonschema.validate(
+        {"metadata": app["metadata"], "spec": {"schedule": "@hourly", "template": app["spec"]}},
+        scheduled,
+    )
+
+    invalid = copy.deepcopy(app)
+    invalid["spec"]["mode"] = "standalone"
+    with pytest.raises(jsonschema.ValidationError):
+        jsonschema.validate(invalid, schema)
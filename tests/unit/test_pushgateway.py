@@ -0,0 +1,28 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+import io
+import json
+from unittest.mock import MagicMock
+
+from pushgateway import evict_stale_groups
+
+
+def _group(job, pushed, **labels):
+    return {
+        "labels": {"job": job, **labels},
+        "push_time_seconds": {"metrics": [{"value": str(pushed)}]},
+    }
+
+
+def test_evict_stale_groups(mocker):
+    groups = {"data": [_group("fresh", 950), _group("stale", 100, instance="spark/driver")]}
+    urlopen = mocker.patch("pushgateway.urlopen")
+    urlopen.side_effect = [io.BytesIO(json.dumps(groups).encode()), MagicMock()]
+
+    assert evict_stale_groups("http://localhost:9091", ttl=300, now=1000) == 1
+
+    request = urlopen.call_args_list[1].args[0]
+    assert request.get_method() == "DELETE"
+    assert request.full_url == (
+        "http://localhost:9091/metrics/job@base64/c3RhbGU=/instance@base64/c3BhcmsvZHJpdmVy"
+    )
@@ -0,0 +1,17 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+from spark_application import with_profile
+
+
+def test_with_profile_keeps_application_conf():
+    manifest = {"spec": {"sparkConf": {"spark.sql.shuffle.partitions": "10"}}}
+
+    profiled = with_profile(
+        manifest, {"spark.sql.shuffle.partitions": "400", "spark.locality.wait": "0s"}
+    )
+
+    assert profiled["spec"]["sparkConf"] == {
+        "spark.sql.shuffle.partitions": "10",
+        "spark.locality.wait": "0s",
+    }
+    assert manifest["spec"]["sparkConf"] == {"spark.sql.shuffle.partitions": "10"}